@@ -0,0 +1,175 @@
+#
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Keystone sessions for cinderlm's tools, with the token kept in a cache on
+# disk so that cron jobs and monasca cycles reuse a token rather than have
+# Keystone issue a new one every run.
+#
+# The cache is a json file readable and writable only by its owner (root),
+# holding the keystoneauth auth state per auth_url, user, project and
+# interface, and counts of cache hits and misses.  A cached token is used
+# until EXPIRY_MARGIN seconds before it expires; a token that Keystone
+# rejects (401) is replaced by the session and the new token cached when
+# the process exits.
+#
+# Sessions are shared within a process: every client built for the same
+# credentials uses one session, so one token and one pool of keep-alive
+# connections per endpoint.
+
+import atexit
+import cinder_cache
+import hashlib
+import json
+from keystoneauth1 import access
+from keystoneauth1 import identity
+from keystoneauth1 import session as ksession
+import requests
+import threading
+
+TOKEN_CACHE_FILE = '/var/cache/cinderlm/.keystone_tokens'
+
+# Seconds before expiry at which a cached token is no longer used
+EXPIRY_MARGIN = 300
+
+# Connection pool of the shared sessions: the number of hosts (keystone,
+# cinder, nova, ...) to keep connections to, and the number of connections
+# kept to each, which should cover the number of threads making requests
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def _expires_soon(state, margin):
+    data = json.loads(state)
+    auth_ref = access.create(body=data['body'], auth_token=data['auth_token'])
+    return auth_ref.will_expire_soon(margin)
+
+
+class TokenCache(object):
+    """Keystone auth state cached in a root only file."""
+
+    def __init__(self, path=TOKEN_CACHE_FILE):
+        self.path = path
+
+    @staticmethod
+    def key(auth_url, username, project_name, interface):
+        return hashlib.sha256('|'.join(
+            [auth_url, username, project_name, interface]).encode(
+                'utf-8')).hexdigest()
+
+    def _update(self, update):
+        """Call update(data) on the locked cache contents and save them.
+
+           Returns the value returned by update, or None if the cache
+           cannot be used.
+        """
+        return cinder_cache.update_json_file(self.path, update)
+
+    def load(self, key):
+        """Return the cached auth state for key and count a hit or miss.
+
+           Only returns state whose token is not about to expire.
+        """
+        def update(data):
+            stats = data.setdefault('stats', {'hits': 0, 'misses': 0})
+            state = data.get('tokens', {}).get(key)
+            if state is not None and _expires_soon(state, EXPIRY_MARGIN):
+                state = None
+            stats['hits' if state else 'misses'] += 1
+            return state
+        return self._update(update)
+
+    def save(self, key, state):
+        def update(data):
+            tokens = data.setdefault('tokens', {})
+            tokens[key] = state
+            # drop tokens that have expired, e.g. for old passwords
+            for k, s in list(tokens.items()):
+                if _expires_soon(s, 0):
+                    del tokens[k]
+        self._update(update)
+
+    def stats(self):
+        return self._update(lambda data: dict(data.get('stats', {})))
+
+
+def _pooled_requests_session():
+    session = requests.Session()
+    for scheme in ('http://', 'https://'):
+        session.mount(scheme, ksession.TCPKeepAliveAdapter(
+            pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE))
+    return session
+
+
+def get_session(auth_url, username, password, project_name,
+                interface='internalURL', cacert=None,
+                user_domain_name='Default', project_domain_name='Default',
+                cache=None):
+    """Return the shared keystoneauth Session for a set of credentials.
+
+       The first call for a set of credentials authenticates from the
+       token cache, or if there is no usable cached token authenticates
+       straight away and caches the new token.
+    """
+    cache = cache or TokenCache()
+    key = cache.key(auth_url, username, project_name, interface)
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = _new_session(
+                key, cache, auth_url, username, password, project_name,
+                cacert, user_domain_name, project_domain_name)
+        return _sessions[key]
+
+
+def _new_session(key, cache, auth_url, username, password, project_name,
+                 cacert, user_domain_name, project_domain_name):
+    plugin = identity.Password(auth_url=auth_url,
+                               username=username,
+                               password=password,
+                               project_name=project_name,
+                               user_domain_name=user_domain_name,
+                               project_domain_name=project_domain_name)
+    session = ksession.Session(auth=plugin, verify=cacert or True,
+                               session=_pooled_requests_session())
+    state = cache.load(key)
+    if state is not None:
+        plugin.set_auth_state(state)
+    else:
+        plugin.get_access(session)
+        state = plugin.get_auth_state()
+        cache.save(key, state)
+
+    def save_reauthenticated():
+        # the session replaces a token rejected by Keystone
+        new_state = plugin.get_auth_state()
+        if new_state and new_state != state:
+            cache.save(key, new_state)
+    atexit.register(save_reauthenticated)
+    return session
+
+
+def token_cache_metrics(timestamp, cache=None):
+    """Metrics for the cumulative token cache hits and misses."""
+    stats = (cache or TokenCache()).stats()
+    if not stats:
+        return []
+    return [cinder_cache.metric('cinderlm.keystone.token_cache.%s' % name,
+                                stats.get(name, 0),
+                                'Keystone token cache %s' % name, timestamp,
+                                component='cinderlm-token-cache')
+            for name in ('hits', 'misses')]
@@ -0,0 +1,210 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Load generation for cinder_check --bench.
+#
+# A number of worker threads each run a cycle of operations (e.g. create a
+# volume, snapshot it, delete it) over and over, for a set time or a set
+# total number of cycles.  Each operation in a cycle is timed; the results
+# are the rate, latency percentiles and error rate of every operation.
+
+import cinder_cache
+import contextlib
+import math
+import threading
+import time
+
+# Name under which whole cycles are recorded
+CYCLE = 'cycle'
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+class Benchmark(object):
+    """Run a cycle of operations from concurrent workers."""
+
+    def __init__(self, workers=4, duration=60, iterations=None,
+                 printer=None, stop_timeout=60):
+        self.workers = workers
+        self.duration = duration
+        self.iterations = iterations
+        self.printer = printer
+        # seconds to wait for cycles in progress when the run is cut short
+        self.stop_timeout = stop_timeout
+        # operation: [seconds, ...] for each successful operation
+        self.latencies = {}
+        # operation: number of failed operations
+        self.errors = {}
+        # operations in the order they were first recorded
+        self.operations = []
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = 0
+
+    def _record(self, operation, seconds=None):
+        with self._lock:
+            if operation not in self.operations:
+                self.operations.append(operation)
+                self.latencies[operation] = []
+                self.errors[operation] = 0
+            if seconds is None:
+                self.errors[operation] += 1
+            else:
+                self.latencies[operation].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, operation):
+        """Time an operation, which counts as an error if it raises."""
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self._record(operation)
+            raise
+        self._record(operation, time.time() - start)
+
+    def _next_iteration(self, deadline):
+        with self._lock:
+            if self._stop.is_set():
+                return None
+            if self.iterations is not None:
+                if self._started >= self.iterations:
+                    return None
+            elif time.time() >= deadline:
+                return None
+            self._started += 1
+            return self._started
+
+    def _run_worker(self, worker, cycle, deadline):
+        while True:
+            iteration = self._next_iteration(deadline)
+            if iteration is None:
+                return
+            try:
+                with self.timer(CYCLE):
+                    cycle(worker, iteration)
+            except Exception as e:
+                if self.printer:
+                    self.printer("Worker %d: cycle %d failed: %s"
+                                 % (worker, iteration, e))
+
+    def run(self, cycle):
+        """Call cycle(worker, iteration) from each worker until done.
+
+           The run ends after duration seconds, or once iterations cycles
+           have been started if iterations is set; cycles that have started
+           are always allowed to finish.  When the run is interrupted (^C)
+           no more cycles are started and those in progress are given
+           stop_timeout seconds to finish, so that what they create can be
+           cleaned up after them.
+        """
+        start = time.time()
+        deadline = start + (self.duration or 0)
+        threads = []
+        for worker in range(self.workers):
+            thread = threading.Thread(target=self._run_worker,
+                                      args=(worker, cycle, deadline))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                # join with a timeout so that ^C is not held up
+                while thread.is_alive():
+                    thread.join(1)
+        finally:
+            self._stop.set()
+            self.elapsed = time.time() - start
+            stop_deadline = time.time() + self.stop_timeout
+            for thread in threads:
+                thread.join(max(stop_deadline - time.time(), 0))
+            running = len([thread for thread in threads if thread.is_alive()])
+            if running and self.printer:
+                self.printer("%d workers still running after %ds, what they "
+                             "create may be left behind"
+                             % (running, self.stop_timeout))
+
+    def summary(self):
+        """Return operation: dict of count, errors, rate and percentiles."""
+        results = {}
+        for operation in self.operations:
+            latencies = sorted(self.latencies[operation])
+            errors = self.errors[operation]
+            total = len(latencies) + errors
+            result = {
+                'count': len(latencies),
+                'errors': errors,
+                'error_rate': float(errors) / total if total else 0.0,
+                'ops_per_sec': (len(latencies) / self.elapsed
+                                if self.elapsed else 0.0),
+            }
+            for pct in PERCENTILES:
+                result['p%d' % pct] = percentile(latencies, pct)
+            results[operation] = result
+        return results
+
+    def report(self):
+        if not self.printer:
+            return
+        summary = self.summary()
+        self.printer("Benchmark: %d workers, %d cycles in %.1fs"
+                     % (self.workers, self._started, self.elapsed))
+        self.printer("%-16s %7s %7s %8s %8s %8s %8s"
+                     % ('operation', 'count', 'errors', 'ops/s',
+                        'p50', 'p95', 'p99'))
+        for operation in self.operations:
+            result = summary[operation]
+            self.printer("%-16s %7d %7d %8.2f %8s %8s %8s"
+                         % ((operation, result['count'], result['errors'],
+                             result['ops_per_sec']) +
+                            tuple('-' if result['p%d' % pct] is None
+                                  else '%.2fs' % result['p%d' % pct]
+                                  for pct in PERCENTILES)))
+
+    def metrics(self, timestamp=None, dimensions=None):
+        """The summary as a list of metric dictionaries."""
+        if timestamp is None:
+            timestamp = time.time()
+        results = []
+        for operation, result in sorted(self.summary().items()):
+            dims = {'operation': operation}
+            dims.update(dimensions or {})
+            values = [('ops_per_sec', result['ops_per_sec'],
+                       '%s operations per second' % operation),
+                      ('error_rate', result['error_rate'],
+                       '%d of %d %s operations failed'
+                       % (result['errors'],
+                          result['errors'] + result['count'], operation))]
+            for pct in PERCENTILES:
+                value = result['p%d' % pct]
+                if value is not None:
+                    values.append(('latency_p%d' % pct, value,
+                                   'p%d %s latency in seconds'
+                                   % (pct, operation)))
+            for name, value, msg in values:
+                results.append(cinder_cache.metric(
+                    'cinderlm.cinder.bench.%s' % name, value, msg,
+                    timestamp, **dims))
+        return results
@@ -0,0 +1,184 @@
+#
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Write metrics files for the monasca plugin to pick up from CACHE_DIR.
+#
+# Files are written to a temporary file and renamed into place so that the
+# plugin never reads a partly written file.  The metrics are wrapped with a
+# generation number, incremented on each write, and the collection time:
+#     {"generation": 12, "timestamp": 1500000000.0, "metrics": [...]}
+# The 'json' and 'compact' formats differ only in indentation, 'msgpack'
+# needs the optional msgpack module.
+#
+# metric() builds the metric dictionaries that cinder_check and its helpers
+# report, update_json_file() keeps the state they share between runs.
+
+import fcntl
+import json
+import os
+import re
+import socket
+import tempfile
+import time
+
+CACHE_DIR = '/var/cache/cinderlm'
+
+FORMATS = ('json', 'compact', 'msgpack')
+
+# This name is known by monasca - do NOT change
+MODULE_SERVICE_NAME = 'block-storage'
+
+_GENERATION_RE = re.compile(br'^\s*\{\s*"generation"\s*:\s*(\d+)')
+
+
+def metric(name, value, msg, timestamp=None, value_meta=None,
+           **dimensions):
+    """Return a metric dictionary.
+
+       The dimensions are added to those of every cinderlm metric; the
+       component is cinder-api unless given.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    dims = {'service': MODULE_SERVICE_NAME,
+            'hostname': socket.gethostname(),
+            'component': 'cinder-api'}
+    dims.update(dimensions)
+    meta = {'msg': msg}
+    meta.update(value_meta or {})
+    return {
+        'metric': name,
+        'value': value,
+        'dimensions': dims,
+        'timestamp': timestamp,
+        'value_meta': meta}
+
+
+def update_json_file(path, update, **dump_args):
+    """Call update(data) on the json contents of a root only file, locked
+       against other runs, and save them.
+
+       Returns the value returned by update, or None if the file cannot be
+       used: it cannot be created, or is not private to this user.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        return None
+    with os.fdopen(fd, 'r+') as f:
+        st = os.fstat(fd)
+        if st.st_uid != os.geteuid() or st.st_mode & 0o077:
+            # someone else can read or has written the file
+            return None
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            data = json.loads(f.read() or '{}')
+        except ValueError:
+            # corrupt, start again
+            data = {}
+        result = update(data)
+        f.seek(0)
+        f.truncate()
+        json.dump(data, f, **dump_args)
+    return result
+
+
+def _msgpack():
+    """Return the msgpack module, None if it is not installed.
+
+       Imported on first use, so that importing this module (as every
+       cinder_diag run does) only loads the standard library.
+    """
+    try:
+        import msgpack
+    except ImportError:
+        return None
+    return msgpack
+
+
+def read_generation(path):
+    """Return the generation of an existing metrics file, 0 if unknown."""
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(64)
+            match = _GENERATION_RE.match(head)
+            if match:
+                return int(match.group(1))
+            msgpack = None
+            if head[:1] not in (b'[', b'{'):
+                msgpack = _msgpack()
+            if msgpack is not None:
+                f.seek(0)
+                doc = msgpack.unpackb(f.read(), raw=False)
+                return int(doc.get('generation', 0))
+    except Exception:  # noqa
+        # missing, unreadable or corrupt, start again
+        pass
+    return 0
+
+
+def _encode(metrics, generation, timestamp, fmt):
+    if fmt == 'msgpack':
+        msgpack = _msgpack()
+        if msgpack is None:
+            raise ValueError('msgpack format needs the msgpack module')
+        return msgpack.packb({'generation': generation,
+                              'timestamp': timestamp,
+                              'metrics': metrics})
+    if fmt == 'compact':
+        body = json.dumps(metrics, sort_keys=True, separators=(',', ':'))
+    else:
+        body = json.dumps(metrics, sort_keys=True, indent=4)
+    # built by hand so that the generation comes first, read_generation
+    # only needs to read the start of the file
+    return ('{"generation": %d, "timestamp": %r, "metrics": %s}\n'
+            % (generation, timestamp, body)).encode('utf-8')
+
+
+def write_metrics(path, metrics, fmt='json', timestamp=None):
+    """Atomically replace path with the given list of metrics.
+
+       Returns the generation number written.
+    """
+    if fmt not in FORMATS:
+        raise ValueError('unknown format: %s' % fmt)
+    if timestamp is None:
+        timestamp = time.time()
+    generation = read_generation(path) + 1
+    data = _encode(metrics, generation, timestamp, fmt)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    # a leading '.' keeps the temporary file out of the plugin's glob
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.%s.' % os.path.basename(path), suffix='.tmp')
+    try:
+        # readable by the monasca agent user
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    except Exception:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return generation
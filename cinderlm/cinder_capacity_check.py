@@ -18,6 +18,7 @@
 
 from __future__ import print_function
 
+import cinder_auth
 from cinderclient.client import Client as CinderClient
 import ConfigParser
 import socket
@@ -64,7 +65,16 @@ def metric(name, value, dimensions, timestamp, msg=None):
     return metric
 
 
+# The client is kept for the life of the process so that long running
+# callers (cinder_diag --daemon and --worker) authenticate once and reuse
+# the token, the client re-authenticates when it expires.
+_cinder_client = None
+
+
 def get_cinder_client():
+    global _cinder_client
+    if _cinder_client is not None:
+        return _cinder_client
 
     cp = ConfigParser.RawConfigParser()
     cp.read(cinderlm_conf_file)
@@ -73,15 +83,23 @@ def get_cinder_client():
     cinderlm_project_name = cp.get('DEFAULT', 'cinderlm_project_name')
     cinderlm_ca_cert_file = cp.get('DEFAULT', 'cinderlm_ca_cert_file')
     keystone_auth_url = cp.get('DEFAULT', 'cinderlm_auth_url')
+    domains = {}
+    for option in ('user_domain_name', 'project_domain_name'):
+        if cp.has_option('DEFAULT', 'cinderlm_' + option):
+            domains[option] = cp.get('DEFAULT', 'cinderlm_' + option)
     cinder_client_version = 2
 
-    return CinderClient(cinder_client_version,
-                        username=cinderlm_username,
-                        api_key=cinderlm_password,
-                        project_id=cinderlm_project_name,
-                        auth_url=keystone_auth_url,
-                        endpoint_type='internalURL',
-                        cacert=cinderlm_ca_cert_file)
+    session = cinder_auth.get_session(keystone_auth_url,
+                                      cinderlm_username,
+                                      cinderlm_password,
+                                      cinderlm_project_name,
+                                      interface='internalURL',
+                                      cacert=cinderlm_ca_cert_file,
+                                      **domains)
+    _cinder_client = CinderClient(cinder_client_version,
+                                  session=session,
+                                  endpoint_type='internalURL')
+    return _cinder_client
 
 
 def _get_capacity():
@@ -171,5 +189,6 @@ def get_capacity():
                                     'backends': 'physical'},
                                    time.time(), physical_backend_string)
         results.append(physical_backends)
+        results.extend(cinder_auth.token_cache_metrics(time.time()))
 
     return results
@@ -0,0 +1,106 @@
+#
+# (c) Copyright 2017 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Read the processes and resource usage of a systemd unit from its cgroup.
+# Both the unified (v2) and the legacy (v1) hierarchies are supported; on
+# hybrid systems the processes are read from the unified hierarchy.
+
+import os
+
+CGROUP_DIR = '/sys/fs/cgroup'
+
+# Units without a slice are looked for in this one
+DEFAULT_SLICE = 'system.slice'
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _read_int(path):
+    value = _read(path)
+    if value is None:
+        return None
+    try:
+        return int(value.strip())
+    except ValueError:
+        # e.g. 'max' in memory.max
+        return None
+
+
+def _unit_path(unit):
+    if '/' not in unit:
+        unit = os.path.join(DEFAULT_SLICE, unit)
+    return unit
+
+
+def is_unified():
+    """True if the cgroup v2 hierarchy is mounted at CGROUP_DIR."""
+    return os.path.exists(os.path.join(CGROUP_DIR, 'cgroup.controllers'))
+
+
+def _unified_usage(unit_dir):
+    usage = {'memory': _read_int(os.path.join(unit_dir, 'memory.current')),
+             'cpu_usec': None}
+    cpu_stat = _read(os.path.join(unit_dir, 'cpu.stat')) or ''
+    for line in cpu_stat.splitlines():
+        key, _, value = line.partition(' ')
+        if key == 'usage_usec':
+            usage['cpu_usec'] = int(value)
+    return usage
+
+
+def _legacy_usage(unit):
+    usage = {'memory': _read_int(os.path.join(
+        CGROUP_DIR, 'memory', unit, 'memory.usage_in_bytes')),
+        'cpu_usec': None}
+    cpu_ns = _read_int(os.path.join(
+        CGROUP_DIR, 'cpuacct', unit, 'cpuacct.usage'))
+    if cpu_ns is not None:
+        usage['cpu_usec'] = cpu_ns // 1000
+    return usage
+
+
+def unit_usage(unit):
+    """Return the pids, memory and cpu usage of a systemd unit.
+
+       Returns a dict with keys 'pids' (list of pid strings), 'memory'
+       (bytes) and 'cpu_usec' (cumulative cpu time in microseconds), the
+       latter two being None where the controller is not available.
+       Returns None if the unit has no cgroup, e.g. it is not running or
+       the host does not use systemd.
+    """
+    unit = _unit_path(unit)
+    if is_unified():
+        unit_dir = os.path.join(CGROUP_DIR, unit)
+        usage_fn = _unified_usage
+        usage_arg = unit_dir
+    else:
+        unit_dir = os.path.join(CGROUP_DIR, 'unified', unit)
+        if not os.path.isdir(unit_dir):
+            unit_dir = os.path.join(CGROUP_DIR, 'systemd', unit)
+        usage_fn = _legacy_usage
+        usage_arg = unit
+    procs = _read(os.path.join(unit_dir, 'cgroup.procs'))
+    if procs is None:
+        return None
+    usage = usage_fn(usage_arg)
+    usage['pids'] = procs.split()
+    return usage
@@ -19,16 +19,73 @@
 from __future__ import print_function
 
 import argparse
+import ConfigParser
+import cinder_auth
+from cinder_bench import Benchmark
+import cinder_cache
+import cinder_latency
+from cinder_stages import CleanupRegistry
+from cinder_stages import StageRunner
+from cinder_sweep import age
+from cinder_sweep import seconds_since
+from cinder_sweep import Sweeper
+from cinder_trace import Tracer
+from cinder_watcher import DELETED
+from cinder_watcher import StatusWatcher
 import cinderclient
 from cinderclient.client import Client as CinderClient
 from datetime import datetime
+import fcntl
+import json
 from novaclient.client import Client as NovaClient
 import os
+import random
+import re
 import sys
 import time
 
 argparser = argparse.ArgumentParser(usage="Cinder Check Utility")
 
+CINDERLM_CONF_FILE = '/etc/cinderlm/cinderlm.conf'
+CINDER_CONF_FILE = '/etc/cinder/cinder.conf'
+
+# Instances of the --instance-pool are named and tagged (in their metadata)
+INSTANCE_POOL_NAME = '__chkvm_pool__'
+INSTANCE_POOL_TAG = ('cinderlm', 'probe-pool')
+INSTANCE_POOL_LOCK_FILE = '/var/cache/cinderlm/.instance_pool.lock'
+
+# Probe resources in a page of a --sweep list call
+SWEEP_PAGE_SIZE = 100
+
+# A warm create from an image must take less than this fraction of the
+# cold create time, or be fast, for the image-volume cache to be working
+IMAGE_CACHE_RATIO = 0.9
+
+# Operations a --bench cycle can be made of, in the order they are run
+BENCH_OPS = ('create', 'snapshot', 'attach', 'delete')
+
+# --bench-timeout waits of a --bench cycle at most: create, snapshot and
+# its delete, attach, detach and delete
+BENCH_CYCLE_WAITS = 6
+
+# --backup-timeout waits of a --backup-bench run after its volume is
+# created: the full and incremental backups and the restore each wait for
+# the backup and a volume, then four deletes
+BACKUP_BENCH_WAITS = 10
+
+# Values of the check status metrics, as in the monasca plugin
+STATUS_OK = 0
+STATUS_FAIL = 2
+
+# Error code of a failed test, e.g. VOLCREATE in "api:VOLCREATE Failed : .."
+_API_ERROR_RE = re.compile(r'api:\s*(\w+)')
+
+
+def error_code(e):
+    """Return the api: error code of an exception, UNKNOWN if it has none"""
+    match = _API_ERROR_RE.search(str(e))
+    return match.group(1).upper() if match else 'UNKNOWN'
+
 
 def create_arguments(parser):
     """Sets up the CLI and config-file options"""
@@ -46,6 +103,12 @@ def create_arguments(parser):
     client_args.add_argument('-p', '--password',
                              default='admin',
                              help='Password')
+    client_args.add_argument('--user-domain', dest='user_domain',
+                             default='Default',
+                             help='User domain name')
+    client_args.add_argument('--project-domain', dest='project_domain',
+                             default='Default',
+                             help='Project domain name')
     client_args.add_argument('--cacert',
                              default='/etc/ssl/certs/ca-certificates.crt',
                              help='CA cert file for TLS/SSL')
@@ -69,12 +132,144 @@ def create_arguments(parser):
     client_args.add_argument('-f', '--full', dest="full",
                              default=False, action="store_true",
                              help="Run a more detailed check")
+    client_args.add_argument('-s', '--snapshots', dest="snapshots",
+                             default=False, action="store_true",
+                             help="Also check snapshots, and creating "
+                                  "volumes from a snapshot and a volume")
+    client_args.add_argument('--parallel', dest="parallel",
+                             default=False, action="store_true",
+                             help="Run the independent stages of a --full "
+                                  "check concurrently")
+    client_args.add_argument('--volume-types', dest="volume_types",
+                             nargs='?', const='', default=None,
+                             help="Run the create/delete check against each "
+                                  "of these comma separated volume types "
+                                  "concurrently; with no list, the "
+                                  "volume_types in the [cinder_check] "
+                                  "section of %s, or else every volume type"
+                                  % CINDERLM_CONF_FILE)
+    client_args.add_argument('--instance-pool', dest="instance_pool",
+                             default=0, type=int,
+                             help="Attach to one of this many long-lived "
+                                  "probe instances, kept between runs, "
+                                  "instead of booting an instance each run")
+    client_args.add_argument('--list-page-size', dest="list_page_size",
+                             default=100, type=int,
+                             help="Volumes in each page of the list test")
+    client_args.add_argument('--list-max-pages', dest="list_max_pages",
+                             default=10, type=int,
+                             help="Pages of volumes the list test fetches "
+                                  "at most, 0 for all of them")
+    client_args.add_argument('--sweep', dest="sweep",
+                             default=False, action="store_true",
+                             help="Delete probe resources left behind by "
+                                  "earlier runs; done before every check "
+                                  "unless --no-sweep is given")
+    client_args.add_argument('--no-sweep', dest="no_sweep",
+                             default=False, action="store_true",
+                             help="Do not sweep before the checks")
+    client_args.add_argument('--sweep-age', dest="sweep_age",
+                             default=7200, type=int,
+                             help="Seconds after which a probe resource is "
+                                  "left behind; raised to the longest run "
+                                  "the timeouts allow")
+    client_args.add_argument('--sweep-workers', dest="sweep_workers",
+                             default=4, type=int,
+                             help="Number of deletes to make at once")
     client_args.add_argument('-i', '--image',
                              default=None,
                              help="Specify the image to boot an instance.")
+    client_args.add_argument('--image-cache', dest="image_cache",
+                             default=False, action="store_true",
+                             help="Create a volume from --image twice and "
+                                  "compare the cold and warm times, for each "
+                                  "of the --volume-types if given")
+    client_args.add_argument('--image-cache-fast', dest="image_cache_fast",
+                             default=20, type=float,
+                             help="Seconds within which a warm create from "
+                                  "the image cache is fast enough, however "
+                                  "long the cold create took")
+    client_args.add_argument('--image-timeout', dest="image_timeout",
+                             default=600, type=int,
+                             help="Seconds to wait for a volume to be "
+                                  "created from an image")
     client_args.add_argument('-l', '--flavor',
                              default=None,
                              help="Specify the flavor to boot an instance.")
+    client_args.add_argument('-j', '--json', dest="json",
+                             default=False, action="store_true",
+                             help="Print the results as a json list of "
+                                  "metrics: the status and duration of the "
+                                  "run and of each step, and those of "
+                                  "--bench, --trace and --latency-store")
+    client_args.add_argument('-o', '--output-file', dest="output_file",
+                             default=None,
+                             help="Atomically write the json results to "
+                                  "this file, e.g. for the monasca plugin "
+                                  "to read from %s" % cinder_cache.CACHE_DIR)
+    client_args.add_argument('--format', dest="format",
+                             default='json', choices=cinder_cache.FORMATS,
+                             help="Format of the output file; compact is "
+                                  "unindented json, msgpack needs the "
+                                  "msgpack module")
+    client_args.add_argument('--latency-store', dest="latency_store",
+                             default=False, action="store_true",
+                             help="Add the time taken by each step to the "
+                                  "latency histograms in %s and report the "
+                                  "rolling percentiles"
+                                  % cinder_latency.LATENCY_STORE_FILE)
+    client_args.add_argument('--latency-windows', dest="latency_windows",
+                             default=cinder_latency.WINDOWS,
+                             help="Comma separated windows to report "
+                                  "rolling percentiles over, e.g. 1h,1d,7d")
+    client_args.add_argument('--trace', dest="trace",
+                             default=False, action="store_true",
+                             help="Time every HTTP request and report the "
+                                  "API and backend time of each step")
+
+    bench_args = parser.add_argument_group('benchmark arguments')
+    bench_args.add_argument('--bench', dest="bench",
+                            default=False, action="store_true",
+                            help="Run a load-generation benchmark of the "
+                                 "Cinder API")
+    bench_args.add_argument('--backup-bench', dest="backup_bench",
+                            default=False, action="store_true",
+                            help="Measure full backup, incremental backup "
+                                 "and restore throughput")
+    bench_args.add_argument('--backup-size', dest="backup_size",
+                            default=10, type=int,
+                            help="Size in GiB of the --backup-bench volume, "
+                                 "created from --image")
+    bench_args.add_argument('--backup-container', dest="backup_container",
+                            default=None,
+                            help="Container to back up to, instead of the "
+                                 "backup driver's default")
+    bench_args.add_argument('--backup-timeout', dest="backup_timeout",
+                            default=3600, type=int,
+                            help="Seconds to wait for each backup, restore "
+                                 "or delete")
+    bench_args.add_argument('--bench-workers', dest="bench_workers",
+                            default=4, type=int,
+                            help="Number of concurrent workers")
+    bench_args.add_argument('--bench-duration', dest="bench_duration",
+                            default=60, type=int,
+                            help="Seconds to start new cycles for")
+    bench_args.add_argument('--bench-iterations', dest="bench_iterations",
+                            default=None, type=int,
+                            help="Total number of cycles to run, instead of "
+                                 "running for --bench-duration")
+    bench_args.add_argument('--bench-ops', dest="bench_ops",
+                            default='create,delete',
+                            help="Comma separated operations in each cycle, "
+                                 "from %s; 'create' is required"
+                                 % ','.join(BENCH_OPS))
+    bench_args.add_argument('--bench-size', dest="bench_size",
+                            default=1, type=int,
+                            help="Size in GiB of the volumes created")
+    bench_args.add_argument('--bench-timeout', dest="bench_timeout",
+                            default=300, type=int,
+                            help="Seconds to wait for each operation, and "
+                                 "for the cycles in progress on ^C")
 
 
 class CinderCheckClient(object):
@@ -85,40 +280,235 @@ class CinderCheckClient(object):
                       'password': options.password,
                       'auth_url': options.auth_url,
                       'interface': options.interface,
-                      'cacert': options.cacert}
+                      'cacert': options.cacert,
+                      'user_domain_name': options.user_domain,
+                      'project_domain_name': options.project_domain}
+        # resources created by the tests that have not been deleted yet
+        self.cleanup = CleanupRegistry()
+        # long-lived instances from the --instance-pool used by this run
+        self.pool_instances = set()
+        # steps of the tests, and their requests with --trace
+        self.tracer = Tracer(self.print)
+        # metric dictionaries of the results of the run
+        self.metrics = []
+        # (kind, id, status, seconds) of every wait of the run, kept by the
+        # watcher of each check
+        self.status_timings = []
+
+    def get_session(self):
+        """Keystone session shared by the cinder and nova clients."""
+        return cinder_auth.get_session(
+            self.creds['auth_url'],
+            self.creds['username'],
+            self.creds['password'],
+            self.creds['tenant_name'],
+            interface=self.creds['interface'],
+            cacert=self.creds['cacert'],
+            user_domain_name=self.creds['user_domain_name'],
+            project_domain_name=self.creds['project_domain_name'])
 
     def get_nova_client(self):
         return NovaClient(self.options.nova_api_version,
-                          username=self.creds['username'],
-                          api_key=self.creds['password'],
-                          project_id=self.creds['tenant_name'],
-                          auth_url=self.creds['auth_url'],
-                          endpoint_type=self.creds['interface'],
-                          cacert=self.creds['cacert'])
+                          session=self.get_session(),
+                          endpoint_type=self.creds['interface'])
 
     def get_api_client(self):
         return CinderClient(self.options.api_version,
-                            username=self.creds['username'],
-                            api_key=self.creds['password'],
-                            project_id=self.creds['tenant_name'],
-                            auth_url=self.creds['auth_url'],
-                            endpoint_type=self.creds['interface'],
-                            cacert=self.creds['cacert'])
+                            session=self.get_session(),
+                            endpoint_type=self.creds['interface'])
 
     def print(self, msg):
-        print("%s: %s" % (datetime.utcnow().isoformat(), msg))
+        # with --json, stdout is kept for the json
+        print("%s: %s" % (datetime.utcnow().isoformat(), msg),
+              file=sys.stderr if self.options.json else sys.stdout)
+
+    def _step(self, operation, msg):
+        """Announce a test step, which is a span of the --trace"""
+        self.print("Test: %s" % msg)
+        self.tracer.begin(operation)
 
     def run_tests(self):
         """Main part of program. Runs tests specified on command line."""
 
-        if self.options.check_api:
-            self.api_tests()
+        checks = (self.options.check_api or self.options.image_cache or
+                  self.options.volume_types is not None or
+                  self.options.backup_bench or self.options.bench)
+        start = time.time()
+        error = None
+        try:
+            if self.options.sweep:
+                self.sweep()
+            elif checks and not self.options.no_sweep:
+                try:
+                    self.sweep()
+                except Exception as e:
+                    # leave the checks to report on the API
+                    self.tracer.fail(error_code(e))
+                    self.print("Sweep failed: %s" % e)
+            if self.options.check_api:
+                self.api_tests()
+            if self.options.volume_types is not None:
+                self.api_tests_volume_types()
+            if self.options.image_cache:
+                self.api_tests_image_cache()
+            if self.options.backup_bench:
+                self.api_backup_bench()
+            if self.options.bench:
+                self.api_bench()
+            if self.options.latency_store:
+                self.store_latencies()
+        except Exception as e:
+            error = e
+            self.tracer.fail(error_code(e))
+            raise
+        finally:
+            self.tracer.end_all()
+            if self.options.trace:
+                self.tracer.uninstall()
+                self.tracer.report()
+                self.metrics.extend(self.tracer.metrics())
+            # failed checks still have results
+            if self.options.json or self.options.output_file:
+                self.run_metrics(start, error)
+            if self.options.output_file:
+                cinder_cache.write_metrics(self.options.output_file,
+                                           self.metrics, self.options.format)
+            elif self.options.json:
+                print(json.dumps(self.metrics, sort_keys=True, indent=4))
+
+    def run_metrics(self, start, error=None):
+        """Add the status and duration of the run and of each step"""
+        timestamp = time.time()
+        # steps that ran more than once are added together
+        steps = {}
+        for span in self.tracer.spans:
+            seconds, step_error = steps.get(span.name, (0.0, None))
+            steps[span.name] = (seconds + span.duration(),
+                                step_error or span.error)
+        for operation, (seconds, step_error) in sorted(steps.items()):
+            self._metric('cinderlm.cinder.check.step.duration', seconds,
+                         'Seconds taken by %s' % operation, timestamp,
+                         operation=operation)
+            if step_error:
+                self._metric('cinderlm.cinder.check.step.status',
+                             STATUS_FAIL,
+                             '%s failed: %s' % (operation, step_error),
+                             timestamp, value_meta={'error': step_error},
+                             operation=operation)
+            else:
+                self._metric('cinderlm.cinder.check.step.status', STATUS_OK,
+                             '%s succeeded' % operation, timestamp,
+                             operation=operation)
+        # the longest time each kind of resource took to reach a status
+        waits = {}
+        for kind, _, status, seconds in self.status_timings:
+            count, longest = waits.get((kind, status), (0, 0.0))
+            waits[(kind, status)] = (count + 1, max(longest, seconds))
+        for (kind, status), (count, longest) in sorted(waits.items()):
+            self._metric('cinderlm.cinder.%s.time_to_status' % kind, longest,
+                         'Seconds for a %s to be %s, the longest of %d'
+                         % (kind, status, count), timestamp, status=status)
+        self._metric('cinderlm.cinder.check.duration', timestamp - start,
+                     'Seconds taken by the run', timestamp)
+        if error is not None:
+            # value_meta is limited to 2048 characters
+            self._metric('cinderlm.cinder.check.status', STATUS_FAIL,
+                         ('Check failed: %s' % error)[:2047], timestamp,
+                         value_meta={'error': error_code(error)})
+        else:
+            self._metric('cinderlm.cinder.check.status', STATUS_OK,
+                         'Check succeeded', timestamp)
+
+    def _setup_clients(self, printer):
+        """Create the cinder and nova clients and the status watcher"""
+        if self.options.trace:
+            self.tracer.install(self.get_session(), self.creds['interface'])
+        self.client = self.get_api_client()
+        self.novaclient = self.get_nova_client()
+        self.watcher = StatusWatcher(
+            self.client, self.novaclient, printer,
+            volume_name_filter=('display_name'
+                                if self.options.api_version == '1'
+                                else 'name'),
+            timings=self.status_timings)
+
+    def _sweep_age(self):
+        """Seconds after which a probe resource is left behind
+
+           --sweep-age, or longer if a run with these timeouts could keep a
+           resource for longer, so that a sweep cannot delete the resources
+           of a run still in progress on another host.
+        """
+        options = self.options
+        backup = (max(options.backup_timeout, options.image_timeout) +
+                  BACKUP_BENCH_WAITS * options.backup_timeout)
+        cycle = BENCH_CYCLE_WAITS * options.bench_timeout
+        if options.bench_iterations:
+            bench = cycle * -(-options.bench_iterations //
+                              max(options.bench_workers, 1))
+        else:
+            bench = options.bench_duration + cycle
+        # volumes are kept to the end of the run without 'delete', when
+        # the cycles in progress are waited for
+        bench += options.bench_timeout
+        return max(options.sweep_age, backup, bench,
+                   2 * options.image_timeout)
+
+    def sweep(self):
+        """Delete probe resources left behind by earlier runs"""
+        # per-resource status lines are only wanted in verbose mode
+        self._setup_clients(self.print if self.options.verbose else None)
+        self._step('sweep', "API Sweep orphaned probe resources")
+        min_age = self._sweep_age()
+        if self.options.verbose and min_age > self.options.sweep_age:
+            self.print("Sweeping probe resources older than %ds, the "
+                       "longest run the timeouts allow" % min_age)
+        sweeper = Sweeper(self.watcher, self.print,
+                          min_age=min_age,
+                          workers=self.options.sweep_workers,
+                          page_size=(None if self.options.api_version == '1'
+                                     else SWEEP_PAGE_SIZE))
+        timestamp = time.time()
+        for kind, removed, failed in sweeper.sweep():
+            if removed:
+                msg = ("Removed %d %ss, the oldest %.1f hours old"
+                       % (len(removed), kind, max(removed) / 3600.0))
+                self._metric('cinderlm.cinder.sweep.oldest_age',
+                             max(removed),
+                             'Age in seconds of the oldest %s removed'
+                             % kind, timestamp, kind=kind)
+            else:
+                msg = "Removed no %ss" % kind
+            if failed:
+                msg += ", failed to remove %s" % ', '.join(failed)
+            if removed or failed:
+                self.print("Sweep: %s" % msg)
+            self._metric('cinderlm.cinder.sweep.removed', len(removed), msg,
+                         timestamp, kind=kind)
+            self._metric('cinderlm.cinder.sweep.failed', len(failed), msg,
+                         timestamp, kind=kind)
+
+    def store_latencies(self):
+        """Merge the step times of this run into the latency store"""
+        windows = cinder_latency.parse_windows(self.options.latency_windows)
+        store = cinder_latency.LatencyStore(
+            keep=max(seconds for _, seconds in windows))
+        store.merge([(span.name, span.duration())
+                     for span in self.tracer.spans])
+        for operation in store.operations():
+            for window, seconds in windows:
+                count, values = store.percentiles(operation, seconds)
+                self.print("Latency: %s over %s: %s (%d samples)" %
+                           (operation, window,
+                            ', '.join('p%d %.2fs' % (pct, values[pct])
+                                      for pct in sorted(values)),
+                            count))
+        self.metrics.extend(store.metrics([window for window, _ in windows]))
 
     def api_tests(self):
         """Run Cinder API  tests"""
         self.print("Cinder API tests")
-        self.client = self.get_api_client()
-        self.novaclient = self.get_nova_client()
+        self._setup_clients(self.print)
         if self.options.api_version == '1':
             self.api_tests_v1()
         elif self.options.api_version == '2':
@@ -135,71 +525,50 @@ class CinderCheckClient(object):
     def _name_for_vers(self, vol, vers):
         return (vol.display_name if vers == '1' else vol.name)
 
-    def _wait_for_instance_status(self, instance_id, status_list, timeout=60):
-        """Loop and wait for instance to reach a specified state."""
-        loop_counter = int(timeout) / 2
-        while loop_counter > 0:
-            loop_counter -= 1
-            try:
-                instance = self.novaclient.servers.get(instance_id)
-                if instance.status not in status_list:
-                    time.sleep(2)
-                else:
-                    break
-            except Exception as e:
-                raise Exception("api:INSTANCEGET #1 Failed : %s" % (e))
-        else:
-            raise Exception("api:INSTANCEGET #1 timed out")
-        self.print("Instance: %s went to state %s." %
-                   (instance_id, instance.status))
-        return instance.status
-
-    def _wait_for_status(self, vol_id, status_list, timeout=60):
-        """Loop and wait for volume to reach a specified state."""
-        loop_counter = int(timeout) / 2
-        while loop_counter > 0:
-            loop_counter -= 1
-            try:
-                vol = self.client.volumes.get(vol_id)
-                if vol.status not in status_list:
-                    time.sleep(2)
-                else:
-                    break
-            except Exception as e:
-                raise Exception("api:VOLGET #1 Failed : %s" % (e))
-        else:
-            raise Exception("api:VOLGET #1 timed out")
-        self.print("Volume: %s went to state %s." % (vol_id, vol.status))
-        return vol.status
-
-    def _wait_for_backup_status(self, bck_id, status_list, timeout=60):
-        """Loop and wait for volume backup to reach a specified state."""
-        loop_counter = int(timeout) / 2
-        while loop_counter > 0:
-            loop_counter -= 1
-            try:
-                bck = self.client.backups.get(bck_id)
-                if bck.status not in status_list:
-                    time.sleep(2)
-                else:
-                    break
-            except Exception as e:
-                raise Exception("api:BCKGET #1 Failed : %s" % (e))
-        else:
-            raise Exception("api:BCKGET #1 timed out")
-        self.print("Backup: %s went to state %s." % (bck_id, bck.status))
-        return bck.status
+    # The name of a resource lets the watcher poll it together with other
+    # resources of the same name, e.g. those of concurrent stages.
 
-    def _api_tests_undo(self, vol_id, bck_id=None, instance_id=None):
+    def _wait_for_instance_status(self, instance_id, status_list, timeout=60,
+                                  name=None):
+        """Wait for instance to reach a specified state."""
+        return self.watcher.wait_for('server', instance_id, status_list,
+                                     timeout, name)
+
+    def _wait_for_status(self, vol_id, status_list, timeout=60, name=None):
+        """Wait for volume to reach a specified state."""
+        return self.watcher.wait_for('volume', vol_id, status_list, timeout,
+                                     name)
+
+    def _wait_for_backup_status(self, bck_id, status_list, timeout=60,
+                                name='__chkvolbck__'):
+        """Wait for volume backup to reach a specified state."""
+        return self.watcher.wait_for('backup', bck_id, status_list, timeout,
+                                     name)
+
+    def _api_tests_undo(self, vol_id, bck_id=None, instance_id=None,
+                        snap_id=None):
         """Perform requested tidyup; on best-effort basis"""
         if instance_id is not None:
             try:
                 self.novaclient.servers.get(instance_id)
                 self.novaclient.servers.delete(instance_id)
+                self.cleanup.discard('server', instance_id)
             except cinderclient.exceptions.NotFound:
-                pass
+                self.cleanup.discard('server', instance_id)
             except Exception as e:
                 self.print("Failed to delete test instance: %s" % e)
+        if snap_id is not None:
+            try:
+                # The volume cannot be deleted until its snapshot has gone
+                self.client.volume_snapshots.delete(snap_id)
+                status = self.watcher.wait_for('snapshot', snap_id, [DELETED])
+                if status != DELETED:
+                    raise Exception("snapshot status is %s" % status)
+                self.cleanup.discard('snapshot', snap_id)
+            except cinderclient.exceptions.NotFound:
+                self.cleanup.discard('snapshot', snap_id)
+            except Exception as e:
+                self.print("Failed to delete test snapshot: %s" % e)
         if vol_id is not None:
             try:
                 # Give the volume one more chance to get into a deleteable
@@ -207,21 +576,35 @@ class CinderCheckClient(object):
                 self._wait_for_status(vol_id, ['available', 'error'])
                 vol = self.client.volumes.get(vol_id)
                 self.client.volumes.delete(vol)
+                self.cleanup.discard('volume', vol_id)
             except cinderclient.exceptions.NotFound:
-                pass
+                self.cleanup.discard('volume', vol_id)
             except Exception as e:
                 self.print("Failed to delete test volume: %s" % e)
         if bck_id is not None:
             try:
                 bckup = self.client.backups.get(bck_id)
                 self.client.backups.delete(bckup)
+                self.cleanup.discard('backup', bck_id)
             except cinderclient.exceptions.NotFound:
-                pass
+                self.cleanup.discard('backup', bck_id)
             except Exception as e:
                 self.print("Failed to delete test backup: %s" % e)
 
-    def api_tests_attach(self, vol_id):
-        self.print("Test: API attach volume")
+    def _api_tests_undo_all(self):
+        """Tidy up everything the tests created that is still around"""
+        for kind, resource_id in self.cleanup.items('server'):
+            self._api_tests_undo(None, None, resource_id)
+        for kind, resource_id in self.cleanup.items('snapshot'):
+            self._api_tests_undo(None, snap_id=resource_id)
+        for kind, resource_id in self.cleanup.items('volume'):
+            self._api_tests_undo(resource_id)
+        for kind, resource_id in self.cleanup.items('backup'):
+            self._api_tests_undo(None, resource_id)
+
+    def _boot_test_instance(self, name='__chkvm__', meta=None):
+        """Boot an instance to attach the test volume to, returns its id"""
+        self._step('instance-boot', "API boot instance")
         #
         # There's nothing much we can do, except use the first image and
         # flavor.
@@ -234,31 +617,158 @@ class CinderCheckClient(object):
         if self.options.flavor is not None:
             flavor = self.options.flavor
             self.print("Booting with the flavor %s" % flavor)
-        instance = self.novaclient.servers.create(name="__chkvm__",
+        instance = self.novaclient.servers.create(name=name,
                                                   image=image,
-                                                  flavor=flavor)
+                                                  flavor=flavor,
+                                                  meta=meta)
+        self.cleanup.add('server', instance.id)
         vm_status = self._wait_for_instance_status(instance.id,
-                                                   ['ACTIVE', 'ERROR'])
+                                                   ['ACTIVE', 'ERROR'],
+                                                   name=name)
         if vm_status != 'ACTIVE':
             self._api_tests_undo(None, None, instance.id)
             raise Exception("api:Instance final status not 'ACTIVE'")
+        return instance.id
+
+    def _pool_state(self, server):
+        """State of a probe pool instance: broken, idle, busy or foreign
+
+           An instance is busy while other runs, here or on other hosts,
+           have test volumes attached to it, and foreign if anything else
+           is attached.  Test volumes attached for longer than the sweep
+           age were left by runs that were killed, they are detached.
+        """
+        status = server.status
+        if status == 'BUILD':
+            status = self._wait_for_instance_status(
+                server.id, ['ACTIVE', 'ERROR'], name=INSTANCE_POOL_NAME)
+        if status != 'ACTIVE':
+            return 'broken'
+        state = 'idle'
+        for attachment in getattr(
+                server, 'os-extended-volumes:volumes_attached', None) or []:
+            try:
+                vol = self.client.volumes.get(attachment['id'])
+            except cinderclient.exceptions.NotFound:
+                continue
+            except Exception as e:
+                raise Exception("api:VOLGET Failed : %s" % (e))
+            if (self._name_for_vers(vol, self.options.api_version) !=
+                    '__chkvol__'):
+                return 'foreign'
+            attached_at = [a.get('attached_at')
+                           for a in getattr(vol, 'attachments', None) or []
+                           if a.get('server_id') == server.id]
+            # the volume was created just before it was attached
+            attached_age = (seconds_since(attached_at[0]) if attached_at
+                            else None)
+            if attached_age is None:
+                attached_age = age(vol)
+            if attached_age is None or attached_age < self._sweep_age():
+                state = 'busy'
+                continue
+            self.print("Detaching volume %s left on probe instance %s" %
+                       (vol.id, server.id))
+            try:
+                self.novaclient.volumes.delete_server_volume(server.id,
+                                                             vol.id)
+            except Exception as e:
+                self.print("Failed to detach volume: %s" % e)
+                state = 'busy'
+        return state
+
+    def _pool_instance(self):
+        """Return the id of a healthy instance from the --instance-pool
+
+           Pool instances are found by name and metadata.  Broken ones are
+           deleted, and instances booted until the pool is full.  Runs are
+           serialised on a lock so that they do not over-fill the pool.  The
+           lock is only held here, and only by runs on this host, so an
+           instance with test volumes attached may be in use and is never
+           deleted.  Every run picks from the same (oldest) instances.
+        """
+        self._step('instance-pool', "API probe instance pool")
+        size = self.options.instance_pool
+        directory = os.path.dirname(INSTANCE_POOL_LOCK_FILE)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0o755)
+        lock_file = open(INSTANCE_POOL_LOCK_FILE, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                servers = self.novaclient.servers.list(
+                    search_opts={'name': '^%s$' % INSTANCE_POOL_NAME})
+            except Exception as e:
+                raise Exception("api:INSTANCELIST Failed : %s" % (e))
+            healthy = []
+            for server in sorted(servers, key=lambda s: (
+                    getattr(s, 'created', None) or '', s.id)):
+                if (server.metadata.get(INSTANCE_POOL_TAG[0]) !=
+                        INSTANCE_POOL_TAG[1]):
+                    continue
+                state = self._pool_state(server)
+                if state == 'foreign':
+                    self.print("Probe instance %s has other volumes "
+                               "attached, leaving it alone" % server.id)
+                    continue
+                if state != 'broken' and len(healthy) < size:
+                    healthy.append(server.id)
+                    continue
+                if state == 'busy':
+                    # more than the pool needs, but in use
+                    continue
+                self.print("Deleting probe instance %s (%s)" %
+                           (server.id, server.status))
+                try:
+                    self.novaclient.servers.delete(server.id)
+                except Exception as e:
+                    self.print("Failed to delete probe instance: %s" % e)
+            while len(healthy) < size:
+                instance_id = self._boot_test_instance(
+                    INSTANCE_POOL_NAME, dict([INSTANCE_POOL_TAG]))
+                # it outlives this run
+                self.cleanup.discard('server', instance_id)
+                healthy.append(instance_id)
+        finally:
+            lock_file.close()
+        self.pool_instances.update(healthy)
+        return random.choice(healthy)
+
+    def _test_instance(self):
+        """Instance for the attach test, from the pool or booted for it"""
+        if self.options.instance_pool:
+            return self._pool_instance()
+        return self._boot_test_instance()
 
+    def api_tests_attach(self, vol_id, instance_id=None):
+        """Attach and detach the test volume, booting an instance if needed"""
+        if instance_id is None:
+            instance_id = self._test_instance()
+        self._step('volume-attach', "API attach volume")
         try:
-            self.novaclient.volumes.create_server_volume(instance.id,
+            self.novaclient.volumes.create_server_volume(instance_id,
                                                          vol_id, None)
-            self._wait_for_status(vol_id, ['in-use', 'error'])
-            self.novaclient.volumes.delete_server_volume(instance.id,
+            self._wait_for_status(vol_id, ['in-use', 'error'],
+                                  name='__chkvol__')
+            self.novaclient.volumes.delete_server_volume(instance_id,
                                                          vol_id)
-            self._wait_for_status(vol_id, ['available', 'error'])
+            self._wait_for_status(vol_id, ['available', 'error'],
+                                  name='__chkvol__')
         except Exception as e:
-            self._api_tests_undo(vol_id, None, instance.id)
+            # pool instances are shared with other runs, the next run's
+            # _pool_state decides whether one is still healthy
+            if instance_id in self.pool_instances:
+                instance_id = None
+            self._api_tests_undo(vol_id, None, instance_id)
             raise Exception("api:Instance exception in attach/detach - %s" % e)
 
-        self.novaclient.servers.delete(instance)
+        if instance_id not in self.pool_instances:
+            self.novaclient.servers.delete(instance_id)
+            self.cleanup.discard('server', instance_id)
 
     def api_tests_backup(self, vol_id, do_restore=True):
         """Cinder backup API tests: list, create, restore, delete"""
-        self.print("Test: API Backup list")
+        self._step('backup-list', "API Backup list")
         try:
             test_vol_backup_list = self.client.backups.list()
         except Exception as e:
@@ -268,17 +778,19 @@ class CinderCheckClient(object):
                 self.print("Backup: %s; volume: %s backup status: %s" %
                            (bck.id, bck.volume_id, bck.status))
 
-        self.print("Test: API Backup create")
+        self._step('backup-create', "API Backup create")
         try:
             test_vol_backup = self.client.backups.create(
                 vol_id, name='__chkvolbck__')
         except Exception as e:
             raise Exception("api:BACKUP create Failed : %s" % (e))
+        self.cleanup.add('backup', test_vol_backup.id)
 
         # volume status will be 'backing-up' for a while
         # wait for the backup to be done
         vol_status = self._wait_for_status(vol_id,
-                                           ['available', 'error'])
+                                           ['available', 'error'],
+                                           name='__chkvol__')
         if vol_status != 'available':
             self._api_tests_undo(None, test_vol_backup.id)
             raise Exception("api:BACKUP final status not 'available'")
@@ -287,65 +799,205 @@ class CinderCheckClient(object):
         # TODO: for added bonus - check the swift container for files
 
         if do_restore:
-            self.print("Test: API Backup restore")
+            self._step('backup-restore', "API Backup restore")
             try:
                 restore = self.client.restores.restore(test_vol_backup.id)
                 restore_vol_id = restore.volume_id
+                self.cleanup.add('volume', restore_vol_id)
             except Exception as e:
                 self._api_tests_undo(None, test_vol_backup.id)
                 raise Exception("api:BACKUP restore Failed : %s" % (e))
 
-            vol_status = self._wait_for_status(restore_vol_id,
-                                               ['available', 'error'])
-            if vol_status != 'available':
+            # backup status will be 'restoring' for a while, wait for the
+            # restored volume and the backup together
+            statuses = self.watcher.wait(
+                [('volume', restore_vol_id, ['available', 'error']),
+                 ('backup', test_vol_backup.id, ['available', 'error'],
+                  '__chkvolbck__')])
+            if statuses[('volume', restore_vol_id)] != 'available':
                 self._api_tests_undo(restore_vol_id, test_vol_backup.id)
                 raise Exception("api:RESTORE final vol status not 'available'")
-
-            # backup status will be 'restoring' for a while
-            bck_status = self._wait_for_backup_status(test_vol_backup.id,
-                                                      ['available', 'error'])
-            if bck_status != 'available':
+            if statuses[('backup', test_vol_backup.id)] != 'available':
                 self._api_tests_undo(restore_vol_id, test_vol_backup.id)
                 raise Exception("api:RESTORE final bck status not 'available'")
 
             # Now delete the restored volume
             self._api_tests_undo(restore_vol_id)
 
-        self.print("Test: API Backup delete")
+        self._step('backup-delete', "API Backup delete")
         try:
             self.client.backups.delete(test_vol_backup)
+            self.cleanup.discard('backup', test_vol_backup.id)
         except Exception as e:
             raise Exception("api:BACKUP delete Failed : %s" % (e))
             # TODO: check the backup is actually gone
             #       the backup status goes to 'deleting'
 
-    def api_tests_common(self, vers):
-        """Basic API tests: list, create, delete"""
-        self.print("Test: API List")
+    def _stage(self, fn):
+        """Wrap fn so that its last step ends when it returns"""
+        def run_stage():
+            try:
+                return fn()
+            except Exception as e:
+                self.tracer.fail(error_code(e))
+                raise
+            finally:
+                self.tracer.end()
+        return run_stage
+
+    def api_tests_snapshot(self, vers, vol):
+        """Snapshot and clone tests: snapshot create, volume from snapshot,
+           volume from volume, clone delete and snapshot delete
+
+           On failure the caller tidies up, using the cleanup registry.
+        """
+        self._step('snapshot-create', "API Snapshot create")
+        snap_id = self._create_snapshot(vers, vol.id)
+
+        self._step('volume-from-snapshot', "API Create volume from snapshot")
+        snap_vol_id = self._create_volume(vers, vol.size,
+                                          name='__chkvolclone__',
+                                          code='SNAPCLONE',
+                                          snapshot_id=snap_id).id
+        self._wait_for_volume(snap_vol_id, code='SNAPCLONE',
+                              name='__chkvolclone__')
+
+        self._step('volume-from-volume', "API Create volume from volume")
+        clone_vol_id = self._create_volume(vers, vol.size,
+                                           name='__chkvolclone__',
+                                           code='VOLCLONE',
+                                           source_volid=vol.id).id
+        self._wait_for_volume(clone_vol_id, code='VOLCLONE',
+                              name='__chkvolclone__')
+
+        # on copy-on-write backends the clones can hold on to the snapshot
+        self._step('clone-delete', "API Delete clones")
+        clone_ids = (snap_vol_id, clone_vol_id)
+        for clone_id in clone_ids:
+            try:
+                self.client.volumes.delete(clone_id)
+            except Exception as e:
+                raise Exception("api:VOLDELETE Failed : %s" % (e))
+        statuses = self.watcher.wait(
+            [('volume', clone_id, [DELETED], '__chkvolclone__')
+             for clone_id in clone_ids])
+        for clone_id in clone_ids:
+            if statuses[('volume', clone_id)] != DELETED:
+                raise Exception("api:VOLDELETE final status is %s"
+                                % statuses[('volume', clone_id)])
+            self.cleanup.discard('volume', clone_id)
+
+        self._step('snapshot-delete', "API Snapshot delete")
+        self._delete_snapshot(snap_id)
+
+    def api_tests_stages(self, vers):
+        """Run the --full tests as stages, returns the test volume
+
+           With --parallel, stages that do not depend on each other run
+           concurrently, e.g. the instance boots while the backup runs.  If
+           any stage fails, everything the stages created is torn down.
+        """
+        runner = StageRunner(self.print)
+        runner.add('create',
+                   self._stage(lambda: self._create_test_volume(vers)))
+        runner.add('backup',
+                   self._stage(lambda: self.api_tests_backup(
+                       runner.results['create'].id)),
+                   depends=['create'])
+        runner.add('boot', self._stage(self._test_instance))
+        # a volume cannot be snapshotted while it is being backed up
+        attach_depends = ['backup', 'boot']
+        if self.options.snapshots:
+            runner.add('snapshot',
+                       self._stage(lambda: self.api_tests_snapshot(
+                           vers, runner.results['create'])),
+                       depends=['backup'])
+            attach_depends = ['snapshot', 'boot']
+        runner.add('attach',
+                   self._stage(lambda: self.api_tests_attach(
+                       runner.results['create'].id,
+                       runner.results['boot'])),
+                   depends=attach_depends)
+        # the stages have their own steps
+        self.tracer.end()
         try:
-            test_vol_list = self.client.volumes.list()
-        except cinderclient.exceptions.NotFound as c:
-            print("Error: Check your openstack auth url", file=sys.stderr)
-            raise Exception("api:VOLLIST Failed : %s" % (c))
+            runner.run(concurrent=self.options.parallel)
+        except Exception:
+            self._api_tests_undo_all()
+            raise
+        finally:
+            runner.report()
+        return runner.results['create']
+
+    def _create_volume(self, vers, size, name='__chkvol__',
+                       code='VOLCREATE', **kwargs):
+        """Request a volume, registering it for cleanup; does not wait"""
+        if vers == '1':
+            kwargs['display_name'] = name
+        else:
+            kwargs['name'] = name
+        try:
+            vol = self.client.volumes.create(size, **kwargs)
         except Exception as e:
-            raise Exception("api:VOLLIST Failed : %s" % (e))
-        if self.options.verbose:
-            for vol in test_vol_list:
-                self.print("Volume: %s; name: %s status: %s" %
-                           (vol.id,
-                            (self._name_for_vers(vol, vers)),
-                            vol.status))
+            raise Exception("api:%s Failed : %s" % (code, e))
+        self.cleanup.add('volume', vol.id)
+        return vol
+
+    def _wait_for_volume(self, vol_id, timeout=60, code='VOLCREATE',
+                         name='__chkvol__'):
+        """Wait for a new volume to be available, raising if it is not"""
+        vol_status = self._wait_for_status(vol_id, ['available', 'error'],
+                                           timeout, name)
+        if vol_status != 'available':
+            raise Exception("api:%s final status is not 'available'" % code)
 
-        self.print("Test: API Create - 1GiB volume")
+    def _create_snapshot(self, vers, vol_id, timeout=60):
+        """Snapshot a volume and wait for the snapshot, returns its id"""
         try:
             if vers == '1':
-                test_vol_create = self.client.volumes.create(
-                    1, display_name='__chkvol__')
+                snap = self.client.volume_snapshots.create(
+                    vol_id, display_name='__chkvolsnap__')
             else:
-                test_vol_create = self.client.volumes.create(
-                    1, name='__chkvol__')
+                snap = self.client.volume_snapshots.create(
+                    vol_id, name='__chkvolsnap__')
+        except Exception as e:
+            raise Exception("api:SNAPCREATE Failed : %s" % (e))
+        self.cleanup.add('snapshot', snap.id)
+        snap_status = self.watcher.wait_for('snapshot', snap.id,
+                                            ['available', 'error'], timeout,
+                                            '__chkvolsnap__')
+        if snap_status != 'available':
+            self._api_tests_undo(None, snap_id=snap.id)
+            raise Exception("api:SNAPCREATE final status is not 'available'")
+        return snap.id
+
+    def _delete_snapshot(self, snap_id, timeout=60):
+        """Delete a snapshot and wait for it to be gone"""
+        try:
+            self.client.volume_snapshots.delete(snap_id)
+        except Exception as e:
+            raise Exception("api:SNAPDELETE Failed : %s" % (e))
+        snap_status = self.watcher.wait_for('snapshot', snap_id, [DELETED],
+                                            timeout, '__chkvolsnap__')
+        if snap_status != DELETED:
+            raise Exception("api:SNAPDELETE final status is %s" % snap_status)
+        self.cleanup.discard('snapshot', snap_id)
+
+    def _delete_volume(self, vol_id, timeout=60, name='__chkvol__'):
+        """Delete a volume and wait for it to be gone"""
+        try:
+            self.client.volumes.delete(vol_id)
         except Exception as e:
-            raise Exception("api:VOLCREATE Failed : %s" % (e))
+            raise Exception("api:VOLDELETE Failed : %s" % (e))
+        vol_status = self._wait_for_status(vol_id, [DELETED], timeout, name)
+        if vol_status != DELETED:
+            raise Exception("api:VOLDELETE final status is %s" % vol_status)
+        self.cleanup.discard('volume', vol_id)
+
+    def _create_test_volume(self, vers):
+        """Create the 1GiB test volume and wait for it to be available"""
+        self._step('volume-create', "API Create - 1GiB volume")
+        test_vol_create = self._create_volume(vers, 1)
         if self.options.verbose:
             self.print("Volume: %s; name: %s status: %s" %
                        (test_vol_create.id,
@@ -354,22 +1006,94 @@ class CinderCheckClient(object):
 
         # Loop and wait for volume to go active
         vol_status = self._wait_for_status(test_vol_create.id,
-                                           ['available', 'error'])
+                                           ['available', 'error'],
+                                           name='__chkvol__')
         if vol_status != 'available':
             self._api_tests_undo(test_vol_create.id)
             raise Exception("api:VOLCREATE final status is not 'available'")
+        return test_vol_create
 
-        if self.options.full:
+    def _volume_pages(self, vers):
+        """Yield (page of volumes, seconds to fetch it) using limit/marker
+
+           Stops after --list-max-pages pages.  The v1 API has no
+           pagination, so there it is a single page of every volume.
+        """
+        page_size = self.options.list_page_size
+        max_pages = self.options.list_max_pages
+        marker = None
+        pages = 0
+        while not max_pages or pages < max_pages:
+            start = time.time()
             try:
-                self.api_tests_backup(test_vol_create.id)
-                self.api_tests_attach(test_vol_create.id)
-            except Exception:
-                self._api_tests_undo(test_vol_create.id)
-                raise
+                if vers == '1':
+                    page = self.client.volumes.list()
+                else:
+                    page = self.client.volumes.list(marker=marker,
+                                                    limit=page_size)
+            except cinderclient.exceptions.NotFound as c:
+                print("Error: Check your openstack auth url", file=sys.stderr)
+                raise Exception("api:VOLLIST Failed : %s" % (c))
+            except Exception as e:
+                raise Exception("api:VOLLIST Failed : %s" % (e))
+            pages += 1
+            yield page, time.time() - start
+            if vers == '1' or len(page) < page_size:
+                return
+            marker = page[-1].id
+
+    def api_tests_list(self, vers):
+        """Volume list test, a page at a time"""
+        self._step('volume-list', "API List")
+        page_times = []
+        count = 0
+        for page, seconds in self._volume_pages(vers):
+            page_times.append(seconds)
+            count += len(page)
+            if self.options.verbose:
+                for vol in page:
+                    self.print("Volume: %s; name: %s status: %s" %
+                               (vol.id,
+                                (self._name_for_vers(vol, vers)),
+                                vol.status))
+        self.print("Listed %d volumes in %d pages: first page %.2fs, "
+                   "slowest page %.2fs" % (count, len(page_times),
+                                           page_times[0], max(page_times)))
+        timestamp = time.time()
+        self._metric('cinderlm.cinder.volume_list.first_page.latency',
+                     page_times[0], 'Seconds to the first page of volumes',
+                     timestamp)
+        self._metric('cinderlm.cinder.volume_list.page.latency',
+                     sum(page_times) / len(page_times),
+                     'Mean seconds per page of %d volumes over %d pages'
+                     % (self.options.list_page_size, len(page_times)),
+                     timestamp)
+        self._metric('cinderlm.cinder.volume_list.page.max_latency',
+                     max(page_times),
+                     'Seconds for the slowest of %d pages of volumes'
+                     % len(page_times), timestamp)
+        self._metric('cinderlm.cinder.volume_list.pages', len(page_times),
+                     '%d volumes listed' % count, timestamp)
+
+    def api_tests_common(self, vers):
+        """Basic API tests: list, create, delete"""
+        self.api_tests_list(vers)
+
+        if self.options.full:
+            test_vol_create = self.api_tests_stages(vers)
+        else:
+            test_vol_create = self._create_test_volume(vers)
+            if self.options.snapshots:
+                try:
+                    self.api_tests_snapshot(vers, test_vol_create)
+                except Exception:
+                    self._api_tests_undo_all()
+                    raise
 
-        self.print("Test: API Delete")
+        self._step('volume-delete', "API Delete")
         try:
             self.client.volumes.delete(test_vol_create)
+            self.cleanup.discard('volume', test_vol_create.id)
         except cinderclient.exceptions.NotFound as c:
             raise Exception("api:VOLDELETE Failed : %s" % (c))
         except Exception as e:
@@ -390,6 +1114,448 @@ class CinderCheckClient(object):
             except Exception as e:
                 raise Exception("api:VOLGET #2 Failed : %s" % (e))
 
+    def _volume_types(self):
+        """The volume types to run the --volume-types check against"""
+        names = self.options.volume_types
+        if not names:
+            cp = ConfigParser.RawConfigParser()
+            cp.read(CINDERLM_CONF_FILE)
+            if cp.has_option('cinder_check', 'volume_types'):
+                names = cp.get('cinder_check', 'volume_types')
+        try:
+            types = self.client.volume_types.list()
+        except Exception as e:
+            raise Exception("api:TYPELIST Failed : %s" % (e))
+        if not names:
+            return types
+        by_name = dict((vtype.name, vtype) for vtype in types)
+        wanted = [name.strip() for name in names.split(',') if name.strip()]
+        missing = [name for name in wanted if name not in by_name]
+        if missing:
+            raise Exception("api:TYPELIST Failed : no volume type %s"
+                            % ', '.join(missing))
+        return [by_name[name] for name in wanted]
+
+    def _backend_name(self, vtype):
+        """The volume_backend_name of a volume type, as in capacity metrics"""
+        specs = getattr(vtype, 'extra_specs', None)
+        if specs is None:
+            try:
+                specs = vtype.get_keys()
+            except Exception:  # noqa
+                specs = {}
+        return specs.get('volume_backend_name', 'undetermined')
+
+    def _probe_volume_type(self, vers, vtype):
+        """Create and delete a volume of a type, returns timings and error"""
+        result = {'create': None, 'delete': None, 'error': None}
+        vol_id = None
+        try:
+            start = time.time()
+            vol_id = self._create_volume(vers, 1,
+                                         volume_type=vtype.name).id
+            self._wait_for_volume(vol_id)
+            result['create'] = time.time() - start
+            start = time.time()
+            self._delete_volume(vol_id)
+            result['delete'] = time.time() - start
+        except Exception as e:
+            result['error'] = str(e)
+            if vol_id is not None:
+                self._api_tests_undo(vol_id)
+        return result
+
+    def _metric(self, name, value, msg, timestamp, value_meta=None,
+                **dimensions):
+        """Add a metric dictionary to the results of the run"""
+        self.metrics.append(cinder_cache.metric(name, value, msg, timestamp,
+                                                value_meta, **dimensions))
+
+    def _run_per_type(self, types, probe):
+        """Run probe(vtype) for each volume type concurrently
+
+           A vtype of None stands for the default volume type.  Returns a
+           list of (vtype, result) and tears down anything left behind.
+        """
+        runner = StageRunner(self.print)
+        for vtype in types:
+            runner.add(vtype.name if vtype else 'default',
+                       self._stage(lambda vtype=vtype: probe(vtype)))
+        # the probes have their own steps
+        self.tracer.end()
+        try:
+            runner.run()
+        finally:
+            self._api_tests_undo_all()
+            runner.report()
+        return [(vtype, runner.results[vtype.name if vtype else 'default'])
+                for vtype in types]
+
+    def api_tests_volume_types(self):
+        """Create/delete check of each volume type, run concurrently"""
+        self.print("Cinder API volume type tests")
+        self._setup_clients(self.print)
+        vers = self.options.api_version
+        results = self._run_per_type(
+            self._volume_types(),
+            lambda vtype: self._probe_volume_type(vers, vtype))
+
+        failed = []
+        timestamp = time.time()
+        for vtype, result in results:
+            backend = self._backend_name(vtype)
+            dimensions = {'volume_type': vtype.name, 'backendname': backend}
+            for operation in ('create', 'delete'):
+                if result[operation] is not None:
+                    self._metric('cinderlm.cinder.volume_type.%s.latency'
+                                 % operation, result[operation],
+                                 'Seconds to %s a volume of type %s'
+                                 % (operation, vtype.name),
+                                 timestamp, **dimensions)
+            if result['error'] is None:
+                msg = ("Volume type %s (backend %s): create %.1fs, "
+                       "delete %.1fs" % (vtype.name, backend,
+                                         result['create'], result['delete']))
+            else:
+                msg = ("Volume type %s (backend %s) failed: %s"
+                       % (vtype.name, backend, result['error']))
+                failed.append(vtype.name)
+            self.print(msg)
+            self._metric('cinderlm.cinder.volume_type.status',
+                         0 if result['error'] is None else 2, msg,
+                         timestamp, **dimensions)
+        if failed:
+            raise Exception("api:VOLTYPE Failed : %s" % ', '.join(failed))
+
+    def _image(self):
+        """The image to create volumes from: --image, else the first one
+
+           --image may be a name or an id, the image returned has the id.
+        """
+        try:
+            if self.options.image is None:
+                return self.novaclient.glance.list()[0]
+            return self.novaclient.glance.find_image(self.options.image)
+        except Exception as e:
+            raise Exception("api:IMAGEGET Failed : %s" % (e))
+
+    def _image_size(self, image):
+        """Smallest volume in GiB that can hold the image"""
+        return max(1, getattr(image, 'min_disk', 0) or 0,
+                   -(-(getattr(image, 'size', 0) or 0) // 1024 ** 3))
+
+    def _probe_image_cache(self, vers, image, vtype):
+        """Create a volume from the image twice, returns the timings
+
+           The volume from the first (cold) create is deleted before the
+           second (warm) create, which the image-volume cache, if enabled,
+           should serve.
+        """
+        result = {'cold': None, 'warm': None, 'error': None,
+                  'backend': self._backend_name(vtype) if vtype else None}
+        size = self._image_size(image)
+        kwargs = {'imageRef': image.id}
+        if vtype is not None:
+            kwargs['volume_type'] = vtype.name
+        vol_id = None
+        try:
+            for phase in ('cold', 'warm'):
+                start = time.time()
+                vol_id = self._create_volume(vers, size,
+                                             name='__chkvolimg__',
+                                             code='IMGCREATE', **kwargs).id
+                self._wait_for_volume(vol_id, self.options.image_timeout,
+                                      code='IMGCREATE', name='__chkvolimg__')
+                result[phase] = time.time() - start
+                if result['backend'] is None:
+                    # host@backend#pool, admin only
+                    host = getattr(self.client.volumes.get(vol_id),
+                                   'os-vol-host-attr:host', None) or ''
+                    result['backend'] = (host.partition('@')[2].partition(
+                        '#')[0] or 'undetermined')
+                self._delete_volume(vol_id, self.options.image_timeout,
+                                    '__chkvolimg__')
+                vol_id = None
+        except Exception as e:
+            result['error'] = str(e)
+            if vol_id is not None:
+                self._api_tests_undo(vol_id)
+        return result
+
+    def api_tests_image_cache(self):
+        """Cold and warm create volume from image, per volume type with
+           --volume-types
+
+           A warm create that is slow and not faster than the cold one
+           means the image-volume cache is disabled or is evicting the image.
+        """
+        self.print("Cinder API image cache tests")
+        self._setup_clients(self.print)
+        vers = self.options.api_version
+        image = self._image()
+        types = [None]
+        if self.options.volume_types is not None:
+            types = self._volume_types()
+        results = self._run_per_type(
+            types, lambda vtype: self._probe_image_cache(vers, image, vtype))
+
+        failed = []
+        timestamp = time.time()
+        for vtype, result in results:
+            name = vtype.name if vtype else 'default'
+            dimensions = {'backendname': result['backend'] or 'undetermined',
+                          'image': image.id}
+            if vtype is not None:
+                dimensions['volume_type'] = vtype.name
+            for phase in ('cold', 'warm'):
+                if result[phase] is not None:
+                    self._metric('cinderlm.cinder.image_volume.%s.latency'
+                                 % phase, result[phase],
+                                 'Seconds for a %s create of a volume of '
+                                 'type %s from image %s'
+                                 % (phase, name, image.id),
+                                 timestamp, **dimensions)
+            if result['error'] is not None:
+                status = 2
+                msg = ("Image volume of type %s failed: %s"
+                       % (name, result['error']))
+                failed.append(name)
+            else:
+                # both creates are warm if the image was already cached
+                status = 0
+                if (result['warm'] > result['cold'] * IMAGE_CACHE_RATIO and
+                        result['warm'] > self.options.image_cache_fast):
+                    status = 1
+                msg = ("Image volume of type %s (backend %s): cold %.1fs, "
+                       "warm %.1fs%s"
+                       % (name, dimensions['backendname'], result['cold'],
+                          result['warm'],
+                          ', warm is not faster, check the image-volume '
+                          'cache' if status else ''))
+                self._metric('cinderlm.cinder.image_volume.warm_ratio',
+                             result['warm'] / result['cold'],
+                             'Warm over cold create time of a volume of '
+                             'type %s from image %s' % (name, image.id),
+                             timestamp, **dimensions)
+            self.print(msg)
+            self._metric('cinderlm.cinder.image_volume.status', status, msg,
+                         timestamp, **dimensions)
+        if failed:
+            raise Exception("api:IMGCREATE Failed : %s" % ', '.join(failed))
+
+    def _backup_driver(self):
+        """The backup_driver in cinder.conf, if it can be read here"""
+        cp = ConfigParser.RawConfigParser()
+        cp.read(CINDER_CONF_FILE)
+        if cp.has_option('DEFAULT', 'backup_driver'):
+            # e.g. cinder.backup.drivers.swift.SwiftBackupDriver
+            return cp.get('DEFAULT', 'backup_driver').split('.')[-1]
+        return 'undetermined'
+
+    def _create_backup(self, vol_id, incremental=False):
+        """Back up a volume and wait for the backup, returns the backup"""
+        kwargs = {'name': '__chkvolbck__'}
+        if self.options.backup_container:
+            kwargs['container'] = self.options.backup_container
+        if incremental:
+            kwargs['incremental'] = True
+        try:
+            bck = self.client.backups.create(vol_id, **kwargs)
+        except Exception as e:
+            raise Exception("api:BACKUP create Failed : %s" % (e))
+        self.cleanup.add('backup', bck.id)
+        bck_status = self._wait_for_backup_status(
+            bck.id, ['available', 'error'], self.options.backup_timeout)
+        if bck_status != 'available':
+            raise Exception("api:BACKUP final status not 'available'")
+        # the volume is 'backing-up' until the backup is done
+        self._wait_for_status(vol_id, ['available', 'error'],
+                              self.options.backup_timeout, '__chkvol__')
+        return self.client.backups.get(bck.id)
+
+    def _delete_backup(self, bck_id):
+        """Delete a backup and wait for it to be gone"""
+        try:
+            self.client.backups.delete(bck_id)
+        except Exception as e:
+            raise Exception("api:BACKUP delete Failed : %s" % (e))
+        bck_status = self._wait_for_backup_status(
+            bck_id, [DELETED], self.options.backup_timeout)
+        if bck_status != DELETED:
+            raise Exception("api:BACKUP delete final status is %s"
+                            % bck_status)
+        self.cleanup.discard('backup', bck_id)
+
+    def api_backup_bench(self):
+        """Backup throughput: full backup and restore of a --backup-size
+           volume, reported in MB/s, and the time of an incremental backup
+
+           The volume is created from --image so that there is data to back
+           up; drivers that skip unallocated or zero chunks will still back
+           up the rest of the volume faster than a volume in use.  Nothing
+           changes between the full and the incremental backup, which only
+           measures the time to find that out.
+        """
+        self.print("Cinder API backup benchmark")
+        self._setup_clients(self.print)
+        vers = self.options.api_version
+        timeout = self.options.backup_timeout
+        image = self._image()
+        size = max(self.options.backup_size, self._image_size(image))
+        phases = []
+        try:
+            self._step('backup-bench-create',
+                       "API Create - %dGiB volume from image %s"
+                       % (size, image.id))
+            vol_id = self._create_volume(vers, size, code='IMGCREATE',
+                                         imageRef=image.id).id
+            self._wait_for_volume(vol_id,
+                                  max(timeout, self.options.image_timeout),
+                                  code='IMGCREATE')
+
+            self._step('backup-full', "API Backup create - full")
+            start = time.time()
+            full = self._create_backup(vol_id)
+            phases.append(('full', time.time() - start, full.container))
+
+            incremental = None
+            if vers == '1':
+                self.print("Incremental backups need API version 2")
+            else:
+                self._step('backup-incremental',
+                           "API Backup create - incremental")
+                start = time.time()
+                incremental = self._create_backup(vol_id, incremental=True)
+                phases.append(('incremental', time.time() - start,
+                               incremental.container))
+
+            # restoring the incremental backup restores the whole chain
+            last = incremental or full
+            self._step('backup-restore', "API Backup restore")
+            start = time.time()
+            try:
+                restore_vol_id = self.client.restores.restore(
+                    last.id).volume_id
+            except Exception as e:
+                raise Exception("api:BACKUP restore Failed : %s" % (e))
+            self.cleanup.add('volume', restore_vol_id)
+            vol_status = self._wait_for_status(restore_vol_id,
+                                               ['available', 'error'],
+                                               timeout)
+            if vol_status != 'available':
+                raise Exception("api:RESTORE final vol status not 'available'")
+            phases.append(('restore', time.time() - start, last.container))
+            # the backup is 'restoring' until the volume is available
+            self._wait_for_backup_status(last.id, ['available', 'error'],
+                                         timeout)
+
+            self._step('backup-bench-delete', "API Backup delete")
+            self._delete_volume(restore_vol_id, timeout, None)
+            # an incremental backup must go before the backup it is based on
+            if incremental is not None:
+                self._delete_backup(incremental.id)
+            self._delete_backup(full.id)
+            self._delete_volume(vol_id, timeout)
+        finally:
+            self._api_tests_undo_all()
+
+        driver = self._backup_driver()
+        timestamp = time.time()
+        for phase, seconds, container in phases:
+            dimensions = {'phase': phase, 'backup_driver': driver,
+                          'container': container or 'undetermined'}
+            self._metric('cinderlm.cinder.backup.latency', seconds,
+                         'Seconds for the %s of a %dGiB volume'
+                         % (phase, size), timestamp, **dimensions)
+            if phase == 'incremental':
+                # no data changed, a rate would only reflect the size
+                self.print("Backup %s of %dGiB: %.1fs"
+                           % (phase, size, seconds))
+                continue
+            rate = size * 1024.0 / seconds
+            self.print("Backup %s of %dGiB: %.1fs, %.1f MB/s"
+                       % (phase, size, seconds, rate))
+            self._metric('cinderlm.cinder.backup.throughput', rate,
+                         'MB/s for the %s of a %dGiB volume'
+                         % (phase, size), timestamp, **dimensions)
+
+    def _bench_cycle(self, bench, ops, vers, instance_id):
+        """One --bench cycle: create a volume and run ops against it"""
+        timeout = self.options.bench_timeout
+        vol_id = None
+        snap_id = None
+        try:
+            with bench.timer('create'):
+                vol_id = self._create_volume(vers,
+                                             self.options.bench_size).id
+                self._wait_for_volume(vol_id, timeout)
+
+            if 'snapshot' in ops:
+                with bench.timer('snapshot'):
+                    snap_id = self._create_snapshot(vers, vol_id, timeout)
+                with bench.timer('snapshot-delete'):
+                    self._delete_snapshot(snap_id, timeout)
+                    snap_id = None
+
+            if 'attach' in ops:
+                with bench.timer('attach'):
+                    self.novaclient.volumes.create_server_volume(
+                        instance_id, vol_id, None)
+                    if self._wait_for_status(vol_id, ['in-use', 'error'],
+                                             timeout,
+                                             '__chkvol__') != 'in-use':
+                        raise Exception(
+                            "api:ATTACH final status is not 'in-use'")
+                with bench.timer('detach'):
+                    self.novaclient.volumes.delete_server_volume(
+                        instance_id, vol_id)
+                    if self._wait_for_status(vol_id, ['available', 'error'],
+                                             timeout,
+                                             '__chkvol__') != 'available':
+                        raise Exception(
+                            "api:DETACH final status is not 'available'")
+
+            if 'delete' in ops:
+                with bench.timer('delete'):
+                    self._delete_volume(vol_id, timeout)
+        except Exception:
+            if vol_id is not None:
+                self._api_tests_undo(vol_id, snap_id=snap_id)
+            raise
+
+    def api_bench(self):
+        """Load-generation benchmark: concurrent volume create/delete cycles
+
+           Volumes are kept until the end of the run when 'delete' is not
+           one of the operations.  Everything created is deleted at the end,
+           whether or not the run succeeded.
+        """
+        ops = [op.strip() for op in self.options.bench_ops.split(',')
+               if op.strip()]
+        if 'create' not in ops or set(ops) - set(BENCH_OPS):
+            raise Exception("Invalid --bench-ops '%s', expected 'create' "
+                            "and any of %s" % (self.options.bench_ops,
+                                               ', '.join(BENCH_OPS[1:])))
+        self.print("Cinder API benchmark: %s" % ', '.join(ops))
+        # per-resource status lines are only wanted in verbose mode
+        self._setup_clients(self.print if self.options.verbose else None)
+        vers = self.options.api_version
+        bench = Benchmark(workers=self.options.bench_workers,
+                          duration=self.options.bench_duration,
+                          iterations=self.options.bench_iterations,
+                          printer=self.print,
+                          stop_timeout=self.options.bench_timeout)
+        try:
+            instance_id = None
+            if 'attach' in ops:
+                instance_id = self._test_instance()
+            bench.run(lambda worker, iteration: self._bench_cycle(
+                bench, ops, vers, instance_id))
+        finally:
+            self._api_tests_undo_all()
+        bench.report()
+        self.metrics.extend(bench.metrics())
+
 
 def main():
     if not os.geteuid() == 0:
@@ -398,10 +1564,24 @@ def main():
 
     create_arguments(argparser)
     args = argparser.parse_args()
+    if args.latency_store:
+        # checked now rather than once the checks have run
+        try:
+            cinder_latency.parse_windows(args.latency_windows)
+        except ValueError as e:
+            argparser.error(str(e))
 
     test = CinderCheckClient(args)
-    test.run_tests()
-    print("Test completed.")
+    if args.json or args.output_file:
+        # the failure is in the results, no need for a traceback
+        try:
+            test.run_tests()
+        except Exception as e:
+            print("Test failed: %s" % e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        test.run_tests()
+        print("Test completed.")
 
 if __name__ == '__main__':
     main()
@@ -19,22 +19,38 @@
 from __future__ import print_function
 
 import argparse
-from cinder_capacity_check import get_capacity
+import cinder_cache
+import cinder_cgroup
+import ConfigParser
+import contextlib
+import fcntl
 import json
+import logging
 import os
+import random
 import re
 import socket
-from swiftlm.hp_hardware import ssacli
-from swiftlm.utils.values import Severity
 import sys
+import tempfile
+import threading
 import time
-import yaml
+
+# Collectors, and their dependencies such as cinderclient, swiftlm and
+# yaml, are only imported when a task that needs them runs: the monasca
+# plugin runs cinder_diag every cycle so its start up time matters.
 
 
 PROC_DIR = '/proc'
+CINDERLM_CONF_FILE = '/etc/cinderlm/cinderlm.conf'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+# Title of a mod_wsgi daemon process, '(wsgi:<process group>)'
+_WSGI_TITLE_RE = re.compile(r'^\(wsgi:([^)]+)\)$')
 
 # This python module implements a single cinder service check to
-# report the number of process of each cinder type running.
+# report the number of process of each cinder type running, and their
+# resource usage.
 # In the longer term the process check should be broken out to
 # constitute one of many newer tests and this file should remain
 # the driver script for ALL diagnostics.
@@ -53,6 +69,55 @@ SUBSERVICES = [
     "cinder-scheduler"
 ]
 
+# Per-service resource usage, each reported as a total and a maximum over
+# the processes of the service e.g. cinderlm.cinder.cinder_services.rss.max
+RESOURCE_METRICS = {
+    'rss': 'resident memory (bytes)',
+    'swap': 'swapped out memory (bytes)',
+    'fds': 'open file descriptors',
+    'threads': 'threads',
+    'cpu': 'cpu usage (percent of one core)',
+}
+
+# Unit-level usage of the systemd unit running each service, read from its
+# cgroup e.g. cinderlm.cinder.cinder_services.unit.memory
+UNIT_METRICS = {
+    'memory': 'unit memory usage (bytes)',
+    'cpu': 'unit cpu usage (percent of one core)',
+}
+
+# The systemd unit of each service, can be overridden in the
+# [cinder_services] section of CINDERLM_CONF_FILE e.g.
+#     [cinder_services]
+#     use_cgroups = True
+#     cinder-volume = openstack-cinder-volume.service
+DEFAULT_UNIT = 'openstack-%s.service'
+
+# Process cpu counters are kept between runs so that cpu usage can be
+# reported as a rate.  Do not give this a .json suffix, the monasca plugin
+# reports every *.json file in cinder_cache.CACHE_DIR.
+PROCESS_STATE_FILE = 'cinder_services.state'
+
+# Defaults for --daemon, overridden in the [daemon] section of
+# CINDERLM_CONF_FILE e.g.
+#     [daemon]
+#     tasks = cinder-services,cinder-capacity
+#     interval = 60
+#     cinder-capacity_interval = 300
+#     jitter = 10
+#     format = compact
+# Each task's results are written to <task>.json in the cache directory.
+DAEMON_TASKS = 'cinder-services,cinder-capacity'
+DAEMON_INTERVAL = 60.0
+DAEMON_JITTER = 10.0
+DAEMON_FORMAT = 'json'
+DAEMON_LOCK_FILE = '.cinder_diag.lock'
+
+log = logging.getLogger('cinder_diag')
+
+# (stage, seconds) for each import and task run, reported by --timings
+TIMINGS = []
+
 
 argparser = argparse.ArgumentParser(usage="Cinder Diagnostics Utility")
 
@@ -65,7 +130,8 @@ def create_arguments(parser):
                              help='Emit json if True, else emit yaml')
     client_args.add_argument('--cinder-services', dest='cinder_services',
                              default=False, action='store_true',
-                             help='Do a process count of cinder services')
+                             help='Do a process count and resource usage '
+                                  'check of cinder services')
     client_args.add_argument('--cinder-capacity', dest='cinder_capacity',
                              default=False, action='store_true',
                              help='Do a check on cinder backend capacity')
@@ -76,9 +142,44 @@ def create_arguments(parser):
     client_args.add_argument('--ssacli', dest='ssacli',
                              default=False, action='store_true',
                              help='Check local disk devices.')
+    client_args.add_argument('--timings', dest='timings',
+                             default=False, action='store_true',
+                             help='Report the time taken to import and run '
+                                  'each stage on stderr')
+    client_args.add_argument('-o', '--output-file', dest='output_file',
+                             default=None,
+                             help='Atomically write the results to this '
+                                  'file instead of printing them, e.g. '
+                                  'for the monasca plugin to read from %s'
+                                  % cinder_cache.CACHE_DIR)
+    client_args.add_argument('--format', dest='format',
+                             default='json', choices=cinder_cache.FORMATS,
+                             help='Format of the output file; compact is '
+                                  'unindented json, msgpack needs the '
+                                  'msgpack module')
+    client_args.add_argument('--daemon', dest='daemon',
+                             default=False, action='store_true',
+                             help='Run tasks periodically, writing their '
+                                  'results to %s; configured in %s'
+                                  % (cinder_cache.CACHE_DIR,
+                                     CINDERLM_CONF_FILE))
+    client_args.add_argument('--worker', dest='worker',
+                             default=False, action='store_true',
+                             help='Run tasks named one per line on stdin, '
+                                  'writing a json result per line to stdout')
+
 
+@contextlib.contextmanager
+def timed(stage):
+    """Record the time taken by a stage in TIMINGS."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        TIMINGS.append((stage, time.time() - start))
 
-def metric(name, value, dimensions, timestamp):
+
+def metric(name, value, dimensions, timestamp, msg=None):
     """Construct the metric dictionary
 
        To list these metrics (for say the last two hours):
@@ -92,52 +193,300 @@ def metric(name, value, dimensions, timestamp):
         'timestamp': timestamp,
     }
 
-    if value > 0:
-        msg = "%s is running" % dimensions['component']
-    else:
-        msg = "%s is not running" % dimensions['component']
+    if msg is None:
+        if value > 0:
+            msg = "%s is running" % dimensions['component']
+        else:
+            msg = "%s is not running" % dimensions['component']
     metric['value_meta'] = {'msg': msg}
 
     return metric
 
 
-def _check_process(name):
-    found = 0
-    pid_re = re.compile("^\d+")
-    for sub_directory in [d for d in os.listdir(PROC_DIR) if pid_re.match(d)]:
-        if (os.path.exists(os.path.join(PROC_DIR, sub_directory, "cmdline"))):
-            cmdline = os.path.join(PROC_DIR, sub_directory, "cmdline")
-            try:
-                if name in open(cmdline, "r").read():
-                    found += 1
-            except IOError:
-                continue
-    return found
+def _read_argv(pid):
+    """Return the argv of a process as a list, or None if it has gone."""
+    try:
+        with open(os.path.join(PROC_DIR, pid, 'cmdline'), 'rb') as f:
+            cmdline = f.read()
+    except (IOError, OSError):
+        return None
+    if not cmdline:
+        # kernel threads and zombies have an empty cmdline
+        return []
+    cmdline = cmdline.decode('utf-8', 'replace')
+    argv = [arg for arg in cmdline.split('\0') if arg]
+    if len(argv) == 1 and ' ' in argv[0]:
+        # processes that rewrite their title (setproctitle) flatten their
+        # argv into a single space separated string
+        argv = argv[0].split()
+    return argv
+
+
+def build_process_index():
+    """Walk PROC_DIR once and return a dict of pid -> argv."""
+    index = {}
+    try:
+        entries = os.listdir(PROC_DIR)
+    except OSError:
+        return index
+    for pid in entries:
+        if not pid.isdigit():
+            continue
+        argv = _read_argv(pid)
+        if argv:
+            index[pid] = argv
+    return index
+
+
+def _program_name(argv):
+    """Return the name of the program an argv is running.
+
+       For interpreters (python, python2.7, ...) the program is the first
+       non-option argument, i.e. the script being run.  mod_wsgi daemon
+       processes are titled after their process group, e.g.
+       '(wsgi:cinder-api) -k start' runs cinder-api.
+    """
+    match = _WSGI_TITLE_RE.match(argv[0])
+    if match:
+        return match.group(1)
+    program = os.path.basename(argv[0]).rstrip(':')
+    if program.startswith('python'):
+        for arg in argv[1:]:
+            if not arg.startswith('-'):
+                return os.path.basename(arg).rstrip(':')
+    return program
+
+
+def match_processes(names, index):
+    """Return a dict of name -> list of pids running that program."""
+    matches = dict((name, []) for name in names)
+    for pid, argv in index.items():
+        program = _program_name(argv)
+        if program in matches:
+            matches[program].append(pid)
+    return matches
 
 
 def check_process(name):
-    return _check_process(name)
+    return len(match_processes([name], build_process_index())[name])
+
+
+def _read_process_stats(pid):
+    """Read the resource usage of a process, None if it has gone.
+
+       Counters that cannot be read (e.g. the fd directory of another
+       user's process when not root) are left out.
+    """
+    pid_dir = os.path.join(PROC_DIR, pid)
+    stats = {}
+    try:
+        with open(os.path.join(pid_dir, 'stat'), 'r') as f:
+            stat = f.read()
+        with open(os.path.join(pid_dir, 'statm'), 'r') as f:
+            statm = f.read().split()
+        with open(os.path.join(pid_dir, 'status'), 'r') as f:
+            status = f.readlines()
+    except (IOError, OSError):
+        return None
+    # The command name in field 2 may contain spaces and parentheses, the
+    # remaining fields start after the last ')'
+    fields = stat[stat.rindex(')') + 2:].split()
+    stats['starttime'] = int(fields[19])
+    stats['cpu_ticks'] = int(fields[11]) + int(fields[12])
+    stats['threads'] = int(fields[17])
+    stats['rss'] = int(statm[1]) * PAGE_SIZE
+    for line in status:
+        if line.startswith('VmSwap:'):
+            stats['swap'] = int(line.split()[1]) * 1024
+    try:
+        stats['fds'] = len(os.listdir(os.path.join(pid_dir, 'fd')))
+    except OSError:
+        pass
+    return stats
+
+
+def _load_process_state():
+    try:
+        with open(os.path.join(cinder_cache.CACHE_DIR, PROCESS_STATE_FILE),
+                  'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_process_state(state):
+    path = os.path.join(cinder_cache.CACHE_DIR, PROCESS_STATE_FILE)
+    tmp_path = None
+    try:
+        # a temporary file of its own, cron, --worker and --daemon runs
+        # may save at the same time
+        fd, tmp_path = tempfile.mkstemp(
+            dir=cinder_cache.CACHE_DIR, prefix='.%s.' % PROCESS_STATE_FILE,
+            suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError):
+        # without saved state the next run cannot report cpu usage, which
+        # is not worth failing the services check for
+        if tmp_path is not None:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def _cpu_percent(pid, stats, previous, now):
+    """Return the cpu usage of a process since the previous run, or None."""
+    prev = previous.get('processes', {}).get(pid)
+    if prev is None or prev['starttime'] != stats['starttime']:
+        # not seen before, or the pid has been reused
+        return None
+    elapsed = now - previous['timestamp']
+    if elapsed <= 0:
+        return None
+    ticks = stats['cpu_ticks'] - prev['cpu_ticks']
+    return 100.0 * ticks / CLOCK_TICKS / elapsed
+
+
+def _resource_metrics(pids, dimensions, previous, state, now):
+    """Return total and max resource metrics over a service's processes.
+
+       The cpu counters of each process are recorded in state for the
+       next run.
+    """
+    usage = dict((resource, []) for resource in RESOURCE_METRICS)
+    for pid in pids:
+        stats = _read_process_stats(pid)
+        if stats is None:
+            continue
+        state['processes'][pid] = {'starttime': stats['starttime'],
+                                   'cpu_ticks': stats['cpu_ticks']}
+        stats['cpu'] = _cpu_percent(pid, stats, previous, now)
+        for resource in RESOURCE_METRICS:
+            if stats.get(resource) is not None:
+                usage[resource].append(stats[resource])
+
+    results = []
+    for resource, description in sorted(RESOURCE_METRICS.items()):
+        values = usage[resource]
+        if not values and (pids or resource == 'cpu'):
+            # unreadable, e.g. /proc/<pid>/fd for another user, or no cpu
+            # rate on the first run or for newly started processes
+            continue
+        for aggregate, value in (('total', sum(values)),
+                                 ('max', max(values or [0]))):
+            msg = '%s %s %s' % (dimensions['component'], aggregate,
+                                description)
+            results.append(metric(
+                '%s.%s.%s' % (MODULE_METRIC_NAME, resource, aggregate),
+                value, dict(dimensions), now, msg))
+    return results
+
+
+def _service_units():
+    """Return a dict of service -> systemd unit, empty if disabled."""
+    cp = ConfigParser.RawConfigParser()
+    cp.read(CINDERLM_CONF_FILE)
+    section = 'cinder_services'
+    if (cp.has_option(section, 'use_cgroups') and
+            not cp.getboolean(section, 'use_cgroups')):
+        return {}
+    units = {}
+    for subservice in SUBSERVICES:
+        if cp.has_option(section, subservice):
+            units[subservice] = cp.get(section, subservice)
+        else:
+            units[subservice] = DEFAULT_UNIT % subservice
+    return units
+
+
+def _unit_metrics(unit, usage, dimensions, previous, state, now):
+    """Return memory and cpu metrics for the cgroup of a systemd unit."""
+    results = []
+    if usage['memory'] is not None:
+        results.append(metric(
+            '%s.unit.memory' % MODULE_METRIC_NAME, usage['memory'],
+            dict(dimensions, unit=unit), now,
+            '%s %s' % (unit, UNIT_METRICS['memory'])))
+    if usage['cpu_usec'] is not None:
+        state['units'][unit] = {'cpu_usec': usage['cpu_usec']}
+        prev = previous.get('units', {}).get(unit)
+        elapsed = now - previous.get('timestamp', now)
+        if (prev is not None and elapsed > 0 and
+                usage['cpu_usec'] >= prev['cpu_usec']):
+            # a counter that went backwards means the unit was restarted
+            cpu = (usage['cpu_usec'] - prev['cpu_usec']) / 1e4 / elapsed
+            results.append(metric(
+                '%s.unit.cpu' % MODULE_METRIC_NAME, cpu,
+                dict(dimensions, unit=unit), now,
+                '%s %s' % (unit, UNIT_METRICS['cpu'])))
+    return results
 
 
 def check_cinder_processes():
+    """Count the processes of each cinder service and their usage.
+
+       The processes of a service are read from the cgroup of its systemd
+       unit where there is one, falling back to a scan of PROC_DIR.
+    """
     results = []
+    now = time.time()
+    units = _service_units()
+    usages = {}
     for subservice in SUBSERVICES:
-        val = check_process(subservice)
-        c = metric(MODULE_METRIC_NAME, val,
-                   {'service': MODULE_SERVICE_NAME,
-                    'hostname': socket.gethostname(),
-                    'component': subservice},
-                   time.time())
+        if subservice in units:
+            usages[subservice] = cinder_cgroup.unit_usage(units[subservice])
+    # one scan of PROC_DIR for all the services without a cgroup
+    fallback_services = [subservice for subservice in SUBSERVICES
+                         if usages.get(subservice) is None]
+    fallback_pids = {}
+    if fallback_services:
+        fallback_pids = match_processes(fallback_services,
+                                        build_process_index())
+    previous = _load_process_state()
+    state = {'timestamp': now, 'processes': {}, 'units': {}}
+    for subservice in SUBSERVICES:
+        dimensions = {'service': MODULE_SERVICE_NAME,
+                      'hostname': socket.gethostname(),
+                      'component': subservice}
+        usage = usages.get(subservice)
+        if usage is not None:
+            # the unit's cgroup also holds helpers such as rootwrap and
+            # privsep daemons, only count the service itself
+            unit_index = {}
+            for pid in usage['pids']:
+                argv = _read_argv(pid)
+                if argv:
+                    unit_index[pid] = argv
+            pids = match_processes([subservice], unit_index)[subservice]
+        else:
+            pids = fallback_pids[subservice]
+        c = metric(MODULE_METRIC_NAME, len(pids), dict(dimensions), now)
         results.append(c)
+        results.extend(
+            _resource_metrics(pids, dimensions, previous, state, now))
+        if usage is not None:
+            results.extend(_unit_metrics(units[subservice], usage,
+                                         dimensions, previous, state, now))
+    _save_process_state(state)
 
     return results
 
 
+def check_capacity():
+    with timed('import cinder_capacity_check'):
+        from cinder_capacity_check import get_capacity
+    return get_capacity()
+
+
 def check_ssacli():
     """GET local smart array status
 
        Wrap swiftlm ssacli diag to get results
     """
+    with timed('import swiftlm.hp_hardware.ssacli'):
+        from swiftlm.hp_hardware import ssacli
     # Needs root privileges to run
     results, slots = ssacli.get_smart_array_info()
     if type(results) != list:
@@ -163,26 +512,173 @@ def check_ssacli():
     return [result.metric() for result in results]
 
 
+# Tasks that can be run by name, the names match the command line options
+TASKS = {
+    'cinder-services': check_cinder_processes,
+    'cinder-capacity': check_capacity,
+    'hpssacli': check_ssacli,
+    'ssacli': check_ssacli,
+}
+
+
+def run_task(task_name):
+    """Run the named task and return its list of metrics."""
+    if task_name not in TASKS:
+        raise ValueError('Unknown task: %s' % task_name)
+    return TASKS[task_name]()
+
+
+def run_worker():
+    """Serve tasks to the monasca plugin over stdin/stdout.
+
+       Each line read is a task name, each line written is a json object
+       with the task name and either its 'metrics' or an 'error'.  Running
+       as a long lived worker saves the plugin starting an interpreter,
+       importing the collectors and authenticating for every task.
+    """
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break
+        task_name = line.strip()
+        if not task_name:
+            continue
+        try:
+            reply = {'task': task_name, 'metrics': run_task(task_name)}
+        except Exception as e:  # noqa
+            reply = {'task': task_name, 'error': str(e)}
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
+
+
+def _daemon_config():
+    """Return ([(task, interval), ...], jitter, format) for --daemon."""
+    cp = ConfigParser.RawConfigParser()
+    cp.read(CINDERLM_CONF_FILE)
+    section = 'daemon'
+
+    def get(option, default):
+        if cp.has_option(section, option):
+            return cp.get(section, option)
+        return default
+
+    interval = float(get('interval', DAEMON_INTERVAL))
+    schedule = []
+    for task_name in get('tasks', DAEMON_TASKS).split(','):
+        task_name = task_name.strip()
+        if not task_name:
+            continue
+        if task_name not in TASKS:
+            raise ValueError('Unknown task in [%s] tasks: %s'
+                             % (section, task_name))
+        schedule.append(
+            (task_name, float(get(task_name + '_interval', interval))))
+    return (schedule, float(get('jitter', DAEMON_JITTER)),
+            get('format', DAEMON_FORMAT))
+
+
+def _lock_daemon():
+    """Take the single instance lock, returns the open lock file."""
+    path = os.path.join(cinder_cache.CACHE_DIR, DAEMON_LOCK_FILE)
+    lock_file = open(path, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def _run_daemon_task(task_name, fmt):
+    path = os.path.join(cinder_cache.CACHE_DIR, task_name + '.json')
+    start = time.time()
+    try:
+        results = run_task(task_name)
+        cinder_cache.write_metrics(path, results, fmt, start)
+    except Exception:  # noqa
+        # the previous results stay in place, the plugin reports their age
+        log.exception('Task %s failed' % task_name)
+    else:
+        log.info('Task %s wrote %d metrics in %.2fs'
+                 % (task_name, len(results), time.time() - start))
+
+
+def run_daemon():
+    """Run tasks at their configured intervals until killed.
+
+       Clients (and so Keystone tokens) are kept between runs.  A task is
+       never started while its previous run is still in progress, the run
+       is skipped instead.  Start times are spread by a random jitter so
+       that tasks, and daemons on different hosts, do not run in step.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    lock_file = _lock_daemon()
+    if lock_file is None:
+        log.error('Another cinder_diag daemon is already running')
+        sys.exit(1)
+    schedule, jitter, fmt = _daemon_config()
+    if not schedule:
+        log.error('No tasks configured')
+        sys.exit(1)
+
+    now = time.time()
+    next_run = dict((task_name, now + random.uniform(0, jitter))
+                    for task_name, interval in schedule)
+    running = {}
+    while True:
+        now = time.time()
+        for task_name, interval in schedule:
+            if now < next_run[task_name]:
+                continue
+            next_run[task_name] = now + interval + random.uniform(0, jitter)
+            thread = running.get(task_name)
+            if thread is not None and thread.is_alive():
+                log.warning('Task %s is still running, skipping this run'
+                            % task_name)
+                continue
+            thread = threading.Thread(target=_run_daemon_task,
+                                      args=(task_name, fmt))
+            thread.daemon = True
+            thread.start()
+            running[task_name] = thread
+        time.sleep(max(min(next_run.values()) - time.time(), 0.1))
+
+
 def main():
     create_arguments(argparser)
     args = argparser.parse_args()
 
+    if args.worker:
+        run_worker()
+        sys.exit(0)
+    if args.daemon:
+        run_daemon()
+
     results = []
-    if args.cinder_services:
-        results = check_cinder_processes()
-    if args.cinder_capacity:
-        results.extend(get_capacity())
-    if args.hpssacli:
-        results.extend(check_ssacli())
-    if args.ssacli:
-        results.extend(check_ssacli())
-    if args.json:
-        print(json.dumps(results, sort_keys=True, indent=4))
-    else:
-        yaml.add_representer(Severity, Severity.yaml_repr, yaml.SafeDumper)
-        print(yaml.safe_dump(results,
-                             allow_unicode=True,
-                             default_flow_style=False))
+    for task_name in ('cinder-services', 'cinder-capacity', 'hpssacli',
+                      'ssacli'):
+        if getattr(args, task_name.replace('-', '_')):
+            with timed('run %s' % task_name):
+                results.extend(run_task(task_name))
+    with timed('output'):
+        if args.output_file:
+            cinder_cache.write_metrics(args.output_file, results,
+                                       args.format)
+        elif args.json:
+            print(json.dumps(results, sort_keys=True, indent=4))
+        else:
+            import yaml
+            from swiftlm.utils.values import Severity
+            yaml.add_representer(Severity, Severity.yaml_repr,
+                                 yaml.SafeDumper)
+            print(yaml.safe_dump(results,
+                                 allow_unicode=True,
+                                 default_flow_style=False))
+    if args.timings:
+        for stage, elapsed in TIMINGS:
+            print('%s: %.3fs' % (stage, elapsed), file=sys.stderr)
     sys.exit(0)
 
 
@@ -0,0 +1,187 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Rolling latency percentiles across cinder_check runs.
+#
+# The latencies of each operation are counted in histograms with buckets
+# growing by BUCKET_GROWTH (so percentiles are within about 5%), one
+# histogram per operation per SLOT_SECONDS.  Slots older than the longest
+# window are dropped, so the store never grows beyond slots * operations *
+# BUCKETS counts.  Only non-empty buckets are stored, as compact json:
+#     {"slot_seconds": 3600,
+#      "slots": {"1500000000": {"volume-create": {"52": 3, "53": 1}}}}
+# Percentiles over a window add up the histograms of the slots it covers.
+
+import cinder_cache
+import math
+import time
+
+LATENCY_STORE_FILE = '/var/cache/cinderlm/.latency_store'
+
+SLOT_SECONDS = 3600
+
+# Latencies from MIN_LATENCY to about an hour, in buckets BUCKET_GROWTH apart
+MIN_LATENCY = 0.01
+BUCKET_GROWTH = 1.1
+BUCKETS = 135
+
+PERCENTILES = (50, 95, 99)
+
+# Default windows to report percentiles over
+WINDOWS = '1h,1d,7d'
+
+_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_window(window):
+    """Return the seconds in a window such as '90s', '30m', '1h' or '7d'."""
+    window = window.strip()
+    if window[-1:] in _UNITS:
+        return int(window[:-1]) * _UNITS[window[-1]]
+    return int(window)
+
+
+def parse_windows(windows):
+    """Return [(window, seconds)] for comma separated windows, e.g. '1h,7d'.
+
+       Raises ValueError if there are none, or one is not a window.
+    """
+    results = []
+    for window in windows.split(','):
+        window = window.strip()
+        if not window:
+            continue
+        try:
+            seconds = parse_window(window)
+        except ValueError:
+            seconds = 0
+        if seconds <= 0:
+            raise ValueError("invalid latency window '%s', expected e.g. "
+                             "90s, 30m, 1h or 7d" % window)
+        results.append((window, seconds))
+    if not results:
+        raise ValueError('no latency windows given')
+    return results
+
+
+def bucket(seconds):
+    if seconds <= MIN_LATENCY:
+        return 0
+    index = int(math.log(seconds / MIN_LATENCY) / math.log(BUCKET_GROWTH))
+    return min(index, BUCKETS - 1)
+
+
+def bucket_value(index):
+    """The latency a bucket stands for, the middle of its range."""
+    return MIN_LATENCY * BUCKET_GROWTH ** (index + 0.5)
+
+
+class LatencyStore(object):
+    """Latency histograms per operation in a root only file."""
+
+    def __init__(self, path=LATENCY_STORE_FILE, keep=7 * 86400,
+                 slot_seconds=SLOT_SECONDS):
+        self.path = path
+        self.keep = keep
+        self.slot_seconds = slot_seconds
+        self.data = {'slot_seconds': slot_seconds, 'slots': {}}
+
+    def _update(self, update):
+        """Call update(data) on the locked store and save it."""
+        def checked(data):
+            if data.get('slot_seconds') != self.slot_seconds:
+                data.clear()
+                data.update({'slot_seconds': self.slot_seconds, 'slots': {}})
+            update(data)
+            return data
+        data = cinder_cache.update_json_file(
+            self.path, checked, separators=(',', ':'), sort_keys=True)
+        if data is None:
+            raise IOError('cannot use the latency store %s' % self.path)
+        self.data = data
+
+    def merge(self, timings, now=None):
+        """Add (operation, seconds) timings to the store and drop old slots.
+
+           Also loads the store, ready for percentiles().
+        """
+        if now is None:
+            now = time.time()
+        slot = str(int(now // self.slot_seconds * self.slot_seconds))
+        oldest = now - self.keep - self.slot_seconds
+
+        def update(data):
+            slots = data['slots']
+            for operation, seconds in timings:
+                counts = slots.setdefault(slot, {}).setdefault(operation, {})
+                index = str(bucket(seconds))
+                counts[index] = counts.get(index, 0) + 1
+            for start in list(slots):
+                if int(start) < oldest:
+                    del slots[start]
+        self._update(update)
+
+    def load(self):
+        self._update(lambda data: None)
+
+    def operations(self):
+        return sorted(set(op for counts in self.data['slots'].values()
+                          for op in counts))
+
+    def percentiles(self, operation, window, now=None):
+        """Return (count, {pct: seconds}) for operation over the window."""
+        if now is None:
+            now = time.time()
+        totals = [0] * BUCKETS
+        for start, counts in self.data['slots'].items():
+            # a slot counts if it ends inside the window
+            if int(start) + self.slot_seconds <= now - window:
+                continue
+            for index, count in counts.get(operation, {}).items():
+                totals[int(index)] += count
+        count = sum(totals)
+        results = {}
+        if count:
+            for pct in PERCENTILES:
+                rank = int(math.ceil(pct / 100.0 * count))
+                seen = 0
+                for index, bucket_count in enumerate(totals):
+                    seen += bucket_count
+                    if seen >= rank:
+                        results[pct] = bucket_value(index)
+                        break
+        return count, results
+
+    def metrics(self, windows, timestamp=None):
+        """Rolling percentiles as metric dictionaries.
+
+           windows is a list of window names such as '1h' or '7d'.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        results = []
+        for operation in self.operations():
+            for window in windows:
+                count, values = self.percentiles(operation,
+                                                 parse_window(window),
+                                                 timestamp)
+                for pct in sorted(values):
+                    results.append(cinder_cache.metric(
+                        'cinderlm.cinder.latency.p%d' % pct, values[pct],
+                        'p%d %s latency over %s (%d samples)'
+                        % (pct, operation, window, count), timestamp,
+                        operation=operation, window=window))
+        return results
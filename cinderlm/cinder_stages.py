@@ -0,0 +1,143 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Run the stages of a cinder_check probe, concurrently where they do not
+# depend on each other, and keep track of the resources they create so
+# that everything can be torn down when any stage fails.
+
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class CleanupRegistry(object):
+    """Resources created by a probe run that have not been deleted yet."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resources = []
+
+    def add(self, kind, resource_id):
+        with self._lock:
+            if (kind, resource_id) not in self._resources:
+                self._resources.append((kind, resource_id))
+
+    def discard(self, kind, resource_id):
+        with self._lock:
+            if (kind, resource_id) in self._resources:
+                self._resources.remove((kind, resource_id))
+
+    def items(self, kind=None):
+        """Registered (kind, id) pairs, most recently created first."""
+        with self._lock:
+            return [r for r in reversed(self._resources)
+                    if kind is None or r[0] == kind]
+
+
+class StageRunner(object):
+    """Run named stages once the stages they depend on have completed.
+
+       Stages that are ready run concurrently, each in its own thread.  If
+       a stage fails no further stages are started and, once the running
+       stages have finished, the first failure is raised.
+    """
+
+    def __init__(self, printer=None):
+        self.printer = printer
+        self.stages = []
+        self.results = {}
+        # name: (start, end) in seconds since the run started
+        self.timings = {}
+        self._depends = {}
+
+    def add(self, name, fn, depends=()):
+        self.stages.append((name, fn))
+        self._depends[name] = tuple(depends)
+
+    def _run_stage(self, name, fn, done):
+        start = time.time() - self._start
+        try:
+            self.results[name] = fn()
+        except Exception as e:
+            done.put((name, start, e))
+        else:
+            done.put((name, start, None))
+
+    def run(self, concurrent=True):
+        done = queue.Queue()
+        self._start = time.time()
+        waiting = list(self.stages)
+        running = 0
+        failure = None
+        finished = set()
+        while waiting or running:
+            ready = [] if failure else [
+                (name, fn) for name, fn in waiting
+                if all(d in finished for d in self._depends[name])]
+            if not concurrent:
+                ready = ready[:1] if not running else []
+            for name, fn in ready:
+                waiting.remove((name, fn))
+                running += 1
+                thread = threading.Thread(target=self._run_stage,
+                                          args=(name, fn, done))
+                thread.daemon = True
+                thread.start()
+            if not running:
+                break
+            name, start, error = done.get()
+            running -= 1
+            self.timings[name] = (start, time.time() - self._start)
+            if error is not None:
+                failure = failure or error
+            else:
+                finished.add(name)
+        if failure is not None:
+            raise failure
+        if waiting:
+            raise Exception("Stages %s depend on stages that were not run"
+                            % ', '.join(name for name, fn in waiting))
+
+    def critical_path(self):
+        """Return ([stage, ...], seconds) for the chain that ended last."""
+        if not self.timings:
+            return [], 0.0
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        path = [name]
+        while True:
+            depends = [d for d in self._depends[name] if d in self.timings]
+            if not depends:
+                break
+            name = max(depends, key=lambda n: self.timings[n][1])
+            path.insert(0, name)
+        return path, self.timings[path[-1]][1] - self.timings[path[0]][0]
+
+    def report(self):
+        if not self.printer:
+            return
+        for name, fn in self.stages:
+            if name in self.timings:
+                start, end = self.timings[name]
+                self.printer("Stage %s: %.1fs (started at %.1fs)"
+                             % (name, end - start, start))
+        path, elapsed = self.critical_path()
+        if path:
+            self.printer("Critical path: %s (%.1fs)"
+                         % (' -> '.join(path), elapsed))
@@ -0,0 +1,202 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Delete the resources left behind by cinder_check runs that were killed
+# or timed out.
+#
+# Resources are found by their probe names with filtered list calls, a
+# page at a time, and only those older than a minimum age are deleted so
+# that the resources of a run still in progress are left alone.  Servers
+# go first, so that their volumes are detached, then snapshots, volumes and
+# backups (incremental ones first).  Deletes are made by a bounded number
+# of threads and then waited for together.
+
+from cinder_watcher import DELETED
+from cinder_watcher import is_not_found
+from datetime import datetime
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# kind: names given by cinder_check, in the order kinds are swept.  The
+# instances of the --instance-pool (__chkvm_pool__) are not swept.
+PROBE_NAMES = (
+    ('server', ('__chkvm__',)),
+    ('snapshot', ('__chkvolsnap__',)),
+    ('volume', ('__chkvol__', '__chkvolclone__', '__chkvolimg__')),
+    ('backup', ('__chkvolbck__',)),
+)
+
+
+def _name(resource):
+    return (getattr(resource, 'name', None) or
+            getattr(resource, 'display_name', None))
+
+
+def seconds_since(timestamp, now=None):
+    """Seconds since an API timestamp, None if it cannot be parsed."""
+    if not timestamp:
+        return None
+    if now is None:
+        now = datetime.utcnow()
+    try:
+        # e.g. 2018-01-01T12:00:00.000000 or 2018-01-01T12:00:00Z
+        then = datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    delta = now - then
+    return delta.days * 86400 + delta.seconds
+
+
+def age(resource, now=None):
+    """Seconds since a resource was created, None if unknown."""
+    # cinder resources have created_at, nova servers created
+    return seconds_since(getattr(resource, 'created_at', None) or
+                         getattr(resource, 'created', None), now)
+
+
+class Sweeper(object):
+    """Find and delete old probe resources."""
+
+    def __init__(self, watcher, printer=None, min_age=7200, workers=4,
+                 page_size=100, timeout=300):
+        self.watcher = watcher
+        self.printer = printer
+        self.min_age = min_age
+        self.workers = workers
+        # None for APIs without marker and limit, e.g. cinder v1
+        self.page_size = page_size
+        self.timeout = timeout
+
+    def _pages(self, kind, name):
+        """Yield the resources of a kind with a name, a page at a time."""
+        manager = self.watcher.manager(kind)
+        search_opts = self.watcher.name_filter(kind, name)
+        marker = None
+        while True:
+            try:
+                if self.page_size:
+                    page = manager.list(search_opts=search_opts,
+                                        marker=marker, limit=self.page_size)
+                else:
+                    page = manager.list(search_opts=search_opts)
+            except Exception as e:
+                raise Exception("api:SWEEP list Failed : %s" % (e))
+            for resource in page:
+                yield resource
+            if not self.page_size or len(page) < self.page_size:
+                return
+            marker = page[-1].id
+
+    def find(self, kind, names):
+        """Return [(resource, age), ...] of old resources with the names."""
+        now = datetime.utcnow()
+        found = []
+        for name in names:
+            for resource in self._pages(kind, name):
+                # filters may not be exact matches on every API version
+                if _name(resource) != name:
+                    continue
+                resource_age = age(resource, now)
+                if resource_age is not None and resource_age >= self.min_age:
+                    found.append((resource, resource_age))
+        return found
+
+    def _delete_all(self, kind, found):
+        """Delete resources, returns (ages of those deleted, failures)."""
+        manager = self.watcher.manager(kind)
+        pending = queue.Queue()
+        for item in found:
+            pending.put(item)
+        requested = []
+        failed = []
+        lock = threading.Lock()
+
+        def run():
+            while True:
+                try:
+                    resource, resource_age = pending.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    manager.delete(resource.id)
+                except Exception as e:
+                    if not is_not_found(e):
+                        if self.printer:
+                            self.printer("Failed to delete %s %s: %s"
+                                         % (kind, resource.id, e))
+                        with lock:
+                            failed.append(resource.id)
+                        continue
+                with lock:
+                    requested.append((resource, resource_age))
+
+        threads = [threading.Thread(target=run)
+                   for i in range(min(self.workers, len(found)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not requested:
+            return [], failed
+        try:
+            # by name, so that each probe name is one list call a poll
+            statuses = self.watcher.wait(
+                [(kind, resource.id, [DELETED], _name(resource))
+                 for resource, resource_age in requested], self.timeout)
+        except Exception as e:
+            if self.printer:
+                self.printer("Failed waiting for %s deletes: %s" % (kind, e))
+            return [], failed + [r.id for r, a in requested]
+        removed = []
+        for resource, resource_age in requested:
+            if statuses[(kind, resource.id)] == DELETED:
+                removed.append(resource_age)
+            else:
+                failed.append(resource.id)
+        return removed, failed
+
+    def sweep(self):
+        """Delete old probe resources.
+
+           Returns a list of (kind, [age of each resource removed],
+           [id of each resource that could not be removed]).
+        """
+        results = []
+        for kind, names in PROBE_NAMES:
+            found = self.find(kind, names)
+            if kind == 'backup':
+                # a backup cannot be deleted while it has incrementals
+                batches = [[f for f in found
+                            if getattr(f[0], 'is_incremental', False)],
+                           [f for f in found
+                            if not getattr(f[0], 'is_incremental', False)]]
+            else:
+                batches = [found]
+            removed = []
+            failed = []
+            for batch in batches:
+                if batch:
+                    batch_removed, batch_failed = self._delete_all(kind,
+                                                                   batch)
+                    removed.extend(batch_removed)
+                    failed.extend(batch_failed)
+            results.append((kind, removed, failed))
+        return results
@@ -0,0 +1,236 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Trace the HTTP requests made by cinder_check.
+#
+# A response hook on the keystoneauth session's requests.Session records
+# the API (keystone, cinder, nova, ...), method, URL template, status and
+# duration of every request.  The duration is the time until the response
+# headers were received.  Requests are grouped into spans, one per step of
+# the probe; a step lasts until the thread that began it begins another.
+# The time of a span not spent in requests is time spent waiting for the
+# backends to do the work.
+
+import cinder_cache
+import re
+import threading
+import time
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+# (service type, API name) of the endpoints to look for in the catalog
+SERVICE_TYPES = (('volumev3', 'cinder'),
+                 ('volumev2', 'cinder'),
+                 ('volume', 'cinder'),
+                 ('compute', 'nova'),
+                 ('image', 'glance'),
+                 ('identity', 'keystone'))
+
+# Span of requests made outside any step
+OTHER = 'other'
+
+# UUIDs, hex ids (e.g. project ids) and numbers in URL paths
+_ID_RE = re.compile(r'^([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                    r'[0-9a-f]{12}|[0-9a-f]{32}|\d+)$', re.IGNORECASE)
+
+
+def url_template(path):
+    """Return path with the ids in it replaced by '{id}'."""
+    return '/'.join('{id}' if _ID_RE.match(part) else part
+                    for part in path.split('/'))
+
+
+class Span(object):
+    def __init__(self, name, start):
+        self.name = name
+        self.start = start
+        self.end = None
+        # error code of the exception that ended the step, if any
+        self.error = None
+        # (api, method, url template, status, seconds)
+        self.requests = []
+
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def api_time(self):
+        return sum(r[4] for r in self.requests)
+
+
+class Tracer(object):
+    """Record the requests of a keystoneauth session in spans.
+
+       Until install() is called only the duration of the spans is known.
+    """
+
+    def __init__(self, printer=None):
+        self.printer = printer
+        self.spans = []
+        self.other = Span(OTHER, time.time())
+        self._endpoints = []
+        self._session = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self, session, interface=None):
+        """Start recording the requests made through session."""
+        self.uninstall()
+        endpoints = []
+        auth_url = getattr(session.auth, 'auth_url', None)
+        if auth_url:
+            endpoints.append((auth_url.rstrip('/'), 'keystone'))
+        for service_type, api in SERVICE_TYPES:
+            try:
+                url = session.get_endpoint(service_type=service_type,
+                                           interface=interface)
+            except Exception:  # noqa
+                # not in the catalog
+                url = None
+            if url:
+                endpoints.append((url.rstrip('/'), api))
+        # longest first, so that the most specific endpoint matches
+        self._endpoints = sorted(endpoints, key=lambda e: len(e[0]),
+                                 reverse=True)
+        self._session = session.session
+        self._session.hooks['response'].append(self._on_response)
+
+    def uninstall(self):
+        if self._session is not None:
+            self._session.hooks['response'].remove(self._on_response)
+            self._session = None
+
+    def _classify(self, url):
+        """Return (api, url template) for a request URL."""
+        for prefix, api in self._endpoints:
+            if url.startswith(prefix):
+                return api, url_template(urlsplit(url[len(prefix):]).path
+                                         or '/')
+        parts = urlsplit(url)
+        return parts.netloc, url_template(parts.path)
+
+    def _on_response(self, response, *args, **kwargs):
+        api, template = self._classify(response.request.url)
+        record = (api, response.request.method, template,
+                  response.status_code, response.elapsed.total_seconds())
+        span = getattr(self._local, 'span', None) or self.other
+        with self._lock:
+            span.requests.append(record)
+
+    def begin(self, name):
+        """Begin a span in this thread, ending the one it had open."""
+        self.end()
+        span = Span(name, time.time())
+        with self._lock:
+            self.spans.append(span)
+        self._local.span = span
+
+    def end(self):
+        """End this thread's open span, if any."""
+        span = getattr(self._local, 'span', None)
+        if span is not None:
+            span.end = time.time()
+            self._local.span = None
+
+    def fail(self, error):
+        """Mark this thread's open span as failed with an error code."""
+        span = getattr(self._local, 'span', None)
+        if span is not None and span.error is None:
+            span.error = error
+
+    def end_all(self):
+        now = time.time()
+        for span in self.spans:
+            if span.end is None:
+                span.end = now
+
+    def _all_spans(self):
+        if self.other.requests:
+            return self.spans + [self.other]
+        return list(self.spans)
+
+    def report(self):
+        if not self.printer:
+            return
+        requests = {}
+        for span in self._all_spans():
+            per_api = {}
+            for api, method, template, status, seconds in span.requests:
+                per_api[api] = per_api.get(api, 0.0) + seconds
+                count, total, slowest, errors = requests.get(
+                    (api, method, template), (0, 0.0, 0.0, 0))
+                requests[(api, method, template)] = (
+                    count + 1, total + seconds, max(slowest, seconds),
+                    errors + (1 if status >= 400 else 0))
+            if span is self.other:
+                self.printer("Trace: %s: %.2fs in %d requests (%s)"
+                             % (span.name, span.api_time(),
+                                len(span.requests),
+                                ', '.join('%s %.2fs' % a
+                                          for a in sorted(per_api.items()))))
+                continue
+            self.printer("Trace: %s: %.2fs, %.2fs in %d requests (%s), "
+                         "%.2fs waiting"
+                         % (span.name, span.duration(), span.api_time(),
+                            len(span.requests),
+                            ', '.join('%s %.2fs' % a
+                                      for a in sorted(per_api.items())),
+                            max(span.duration() - span.api_time(), 0.0)))
+        for key in sorted(requests):
+            count, total, slowest, errors = requests[key]
+            self.printer("Trace: %s %s %s: %d requests, %.3fs total, "
+                         "%.3fs max, %d errors"
+                         % (key + (count, total, slowest, errors)))
+
+    def metrics(self, timestamp=None):
+        """API and backend time per step as a list of metric dictionaries.
+
+           Steps that ran more than once are added together.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        api_times = {}
+        backend_times = {}
+        for span in self._all_spans():
+            for api, method, template, status, seconds in span.requests:
+                seconds_total, count = api_times.get((span.name, api),
+                                                     (0.0, 0))
+                api_times[(span.name, api)] = (seconds_total + seconds,
+                                               count + 1)
+            if span is not self.other:
+                backend_times[span.name] = backend_times.get(
+                    span.name, 0.0) + max(span.duration() - span.api_time(),
+                                          0.0)
+        results = []
+
+        def add(name, value, msg, **dims):
+            results.append(cinder_cache.metric(name, value, msg, timestamp,
+                                               **dims))
+
+        for (operation, api), (seconds, count) in sorted(api_times.items()):
+            add('cinderlm.cinder.api.latency', seconds,
+                'Seconds in %s requests during %s' % (api, operation),
+                operation=operation, api=api)
+            add('cinderlm.cinder.api.requests', count,
+                '%s requests during %s' % (api, operation),
+                operation=operation, api=api)
+        for operation, seconds in sorted(backend_times.items()):
+            add('cinderlm.cinder.backend.latency', seconds,
+                'Seconds waiting for the backends during %s' % operation,
+                operation=operation)
+        return results
@@ -0,0 +1,263 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+# Wait for cinder and nova resources used by cinder_check to reach a status.
+#
+# Any number of volumes, backups, snapshots and servers are watched at once.
+# Resources of the same kind and name are polled with one filtered list
+# call, others with a get each.  Threads waiting at the same time share
+# their polls: each round polls every resource any thread is waiting for,
+# and a thread uses the last round if it is newer than its own.  Polling
+# starts fast and backs off, and a resource is done as soon as it reaches
+# one of the wanted statuses or an error status.  Failures raise the 'api:'
+# exceptions cinder_check reports.
+
+import re
+import threading
+import time
+
+# Status given to a resource that no longer exists
+DELETED = 'deleted'
+
+# Statuses from which a resource will not move on by itself
+ERROR_STATUSES = ('error', 'error_deleting', 'error_restoring',
+                  'error_extending', 'error_managing', 'ERROR')
+
+# kind: (error code in exceptions, name in messages)
+KINDS = {
+    'volume': ('VOLGET', 'Volume'),
+    'backup': ('BCKGET', 'Backup'),
+    'snapshot': ('SNAPGET', 'Snapshot'),
+    'server': ('INSTANCEGET', 'Instance'),
+}
+
+
+def is_not_found(e):
+    """True for the 404 of a cinderclient or novaclient exception."""
+    return (getattr(e, 'code', None) == 404 or
+            getattr(e, 'http_status', None) == 404)
+
+
+class StatusWatcher(object):
+    """Wait for resources to reach a status, polling them together."""
+
+    def __init__(self, client, novaclient, printer=None,
+                 min_interval=0.5, max_interval=5.0, backoff=1.5,
+                 volume_name_filter='name', timings=None):
+        self.client = client
+        self.novaclient = novaclient
+        self.printer = printer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        # the v1 API filters volumes and snapshots by display_name
+        self.volume_name_filter = volume_name_filter
+        # (kind, id, status, seconds) for every resource waited for, may be
+        # shared with other watchers
+        self.timings = [] if timings is None else timings
+        self._lock = threading.Lock()
+        # shared polls: (kind, id) -> [(targets, name), ...] of the threads
+        # waiting for it, (kind, id) -> (round, status) of the last round
+        # that polled it, the number of rounds started and finished, and
+        # whether one is running
+        self._cond = threading.Condition(self._lock)
+        self._watched = {}
+        self._results = {}
+        self._started = 0
+        self._finished = 0
+        self._polling = False
+
+    def manager(self, kind):
+        """The client manager of a kind of resource."""
+        if kind == 'volume':
+            return self.client.volumes
+        if kind == 'backup':
+            return self.client.backups
+        if kind == 'snapshot':
+            return self.client.volume_snapshots
+        return self.novaclient.servers
+
+    def name_filter(self, kind, name):
+        """The search_opts that list the resources of a kind by name."""
+        if kind == 'server':
+            # nova matches names as a regular expression
+            return {'name': '^%s$' % re.escape(name)}
+        if kind in ('volume', 'snapshot'):
+            return {self.volume_name_filter: name}
+        return {'name': name}
+
+    def _get(self, kind, resource_id, targets):
+        try:
+            return self.manager(kind).get(resource_id).status
+        except Exception as e:
+            if is_not_found(e) and DELETED in targets:
+                return DELETED
+            raise Exception("api:%s #1 Failed : %s" % (KINDS[kind][0], e))
+
+    def _poll(self, pending):
+        """Return a dict of (kind, id) -> status for the pending resources.
+
+           The status of a resource that could not be polled is the
+           exception to raise for it.
+        """
+        groups = {}
+        for (kind, resource_id), (targets, name) in pending.items():
+            groups.setdefault((kind, name), []).append(resource_id)
+        statuses = {}
+        for (kind, name), ids in groups.items():
+            if name is not None and len(ids) > 1:
+                try:
+                    found = self.manager(kind).list(
+                        search_opts=self.name_filter(kind, name))
+                except Exception as e:
+                    error = Exception("api:%s #1 Failed : %s"
+                                      % (KINDS[kind][0], e))
+                    for resource_id in ids:
+                        statuses[(kind, resource_id)] = error
+                    continue
+                for resource in found:
+                    if resource.id in ids:
+                        statuses[(kind, resource.id)] = resource.status
+            # anything not listed (renamed, or gone) is looked at directly
+            for resource_id in ids:
+                if (kind, resource_id) not in statuses:
+                    targets = pending[(kind, resource_id)][0]
+                    try:
+                        statuses[(kind, resource_id)] = self._get(
+                            kind, resource_id, targets)
+                    except Exception as e:
+                        statuses[(kind, resource_id)] = e
+        return statuses
+
+    def _register(self, pending):
+        """Add resources to those polled for all waiting threads.
+
+           Returns the last poll round finished, whose results are older
+           than the registration.
+        """
+        with self._cond:
+            for key, (targets, name) in pending.items():
+                self._watched.setdefault(key, []).append((targets, name))
+            return self._finished
+
+    def _unregister(self, pending):
+        with self._cond:
+            for key, watch in pending.items():
+                watches = self._watched.get(key, [])
+                if watch in watches:
+                    watches.remove(watch)
+                if not watches:
+                    self._watched.pop(key, None)
+                    self._results.pop(key, None)
+
+    def _shared_poll(self, pending, seen):
+        """Return the statuses of pending resources from a poll after seen.
+
+           A round of polls made by another thread since round seen is used
+           if it has them all, otherwise this thread polls every resource
+           waited for.  Returns (round, dict of (kind, id) -> status).
+        """
+        with self._cond:
+            while True:
+                rounds = [self._results[key][0] if key in self._results
+                          else 0 for key in pending]
+                if min(rounds) > seen:
+                    return min(rounds), dict(
+                        (key, self._results[key][1]) for key in pending)
+                if not self._polling:
+                    break
+                self._cond.wait()
+            self._polling = True
+            self._started += 1
+            poll_round = self._started
+            watched = {}
+            for key, watches in self._watched.items():
+                # a resource is deleted for any thread waiting for that
+                targets = set()
+                for targets_list, name in watches:
+                    targets.update(targets_list)
+                watched[key] = (list(targets), watches[0][1])
+        statuses = {}
+        try:
+            statuses = self._poll(watched)
+        finally:
+            with self._cond:
+                for key, status in statuses.items():
+                    if key in self._watched:
+                        self._results[key] = (poll_round, status)
+                self._finished = poll_round
+                self._polling = False
+                self._cond.notify_all()
+        return poll_round, dict((key, statuses[key]) for key in pending)
+
+    def wait(self, watches, timeout=60):
+        """Wait for resources to reach one of their wanted statuses.
+
+           watches is a list of (kind, id, status_list) or (kind, id,
+           status_list, name) tuples, where name allows resources of the
+           same kind and name to be polled with one list call.  Returns a
+           dict of (kind, id) -> final status, which is an error status if
+           the resource went into error.  Raises an 'api:' exception if
+           any resource has not finished within timeout seconds.
+        """
+        pending = {}
+        for watch in watches:
+            kind, resource_id, targets = watch[:3]
+            name = watch[3] if len(watch) > 3 else None
+            pending[(kind, resource_id)] = (targets, name)
+        results = {}
+        start = time.time()
+        interval = self.min_interval
+        registered = dict(pending)
+        seen = self._register(registered)
+        try:
+            while pending:
+                # nothing is done the moment it was asked for, and the
+                # round of another thread may well have it by now
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    kind = sorted(pending)[0][0]
+                    raise Exception("api:%s #1 timed out" % KINDS[kind][0])
+                time.sleep(min(interval, remaining))
+                interval = min(interval * self.backoff, self.max_interval)
+                seen, statuses = self._shared_poll(pending, seen)
+                elapsed = time.time() - start
+                for key, status in statuses.items():
+                    if isinstance(status, Exception):
+                        raise status
+                    targets = pending[key][0]
+                    if (status not in targets and
+                            status not in ERROR_STATUSES):
+                        continue
+                    kind, resource_id = key
+                    results[key] = status
+                    del pending[key]
+                    with self._lock:
+                        self.timings.append((kind, resource_id, status,
+                                             elapsed))
+                    if self.printer:
+                        self.printer("%s: %s went to state %s in %.1fs." %
+                                     (KINDS[kind][1], resource_id, status,
+                                      elapsed))
+        finally:
+            self._unregister(registered)
+        return results
+
+    def wait_for(self, kind, resource_id, status_list, timeout=60,
+                 name=None):
+        """Wait for a single resource, returning its final status."""
+        return self.wait([(kind, resource_id, status_list, name)],
+                         timeout)[(kind, resource_id)]
@@ -20,16 +20,29 @@
 
 from __future__ import print_function
 
+import codecs
 from collections import defaultdict
 import glob
 import json
 from monasca_agent.collector import checks
 import os
+import select
 import socket
 import subprocess
 import threading
 import time
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    # optional, for metrics files written with 'cinder_diag --format msgpack'
+    import msgpack
+except ImportError:
+    msgpack = None
+
 OK = 0
 WARN = 1
 FAIL = 2
@@ -115,12 +128,290 @@ class CommandRunner(object):
             self.exception = e
 
 
+class WorkerError(Exception):
+    """A worker process could not be started or stopped responding."""
+
+
+class WorkerProcess(object):
+    """A long lived 'cinder_diag --worker' process run over pipes."""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.tasks_run = 0
+
+    def start(self):
+        devnull = open(os.devnull, 'w')
+        try:
+            self.process = subprocess.Popen(
+                self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=devnull, close_fds=True)
+        except (OSError, ValueError) as e:
+            raise WorkerError('failed to start worker: %s' % e)
+        finally:
+            devnull.close()
+        self.tasks_run = 0
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.is_alive():
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+    def _read_line(self, timeout):
+        """Read one line from the worker, None if it timed out."""
+        deadline = time.time() + timeout
+        fd = self.process.stdout.fileno()
+        data = b''
+        while not data.endswith(b'\n'):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                return None
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise WorkerError('worker exited with status %s'
+                                  % self.process.poll())
+            data += chunk
+        return data
+
+    def run_task(self, task_name, timeout):
+        """Run a task in the worker and return the decoded reply.
+
+           Returns None if the task timed out, in which case the worker is
+           stopped since it is still busy with the task.
+        """
+        try:
+            self.process.stdin.write((task_name + '\n').encode('utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise WorkerError('failed to send task to worker: %s' % e)
+        line = self._read_line(timeout)
+        if line is None:
+            self.stop()
+            return None
+        self.tasks_run += 1
+        try:
+            return json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            # the worker's output is out of step, don't reuse it
+            self.stop()
+            raise WorkerError('failed to parse worker reply: %s' % e)
+
+
+class WorkerPool(object):
+    """A small pool of worker processes, started on demand.
+
+       Workers are replaced after max_tasks tasks so that a long running
+       agent picks up a new version of cinderlm and does not accumulate
+       leaks in the collectors.
+    """
+
+    def __init__(self, command, size=1, max_tasks=100):
+        self.command = command
+        self.size = size
+        self.max_tasks = max_tasks
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+
+    def _acquire(self, timeout):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._started < self.size:
+                self._started += 1
+                return WorkerProcess(self.command)
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise WorkerError('no worker became available in %ss' % timeout)
+
+    def _release(self, worker):
+        if worker.tasks_run >= self.max_tasks:
+            worker.stop()
+        self._idle.put(worker)
+
+    def run_task(self, task_name, timeout):
+        worker = self._acquire(timeout)
+        try:
+            if not worker.is_alive():
+                worker.start()
+            return worker.run_task(task_name, timeout)
+        except WorkerError:
+            worker.stop()
+            raise
+        finally:
+            self._release(worker)
+
+    def stop(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+
+def create_file_metric(name, file_name, value, msg):
+    """Generate metric to report on a metrics file read by the plugin."""
+    return dict(
+        metric='%s.file.%s' % (MODULE_METRIC_NAME, name),
+        dimensions={'file': file_name,
+                    'service': SERVICE_NAME,
+                    'hostname': socket.gethostname()},
+        value_meta=dict(msg=msg),
+        value=value)
+
+
+class TruncatedFileError(ValueError):
+    """A metrics file does not contain a complete json document."""
+
+
+def iter_json_list(f, chunk_size=65536):
+    """Parse a file holding a json list, yielding one element at a time.
+
+       Only a chunk of the file and the current element are held in memory
+       rather than the whole text of the file.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    started = eof = False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a json list')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # the element continues in the next chunk
+                if eof:
+                    raise TruncatedFileError('incomplete json element')
+            else:
+                # a number cut off at the end of the chunk decodes too, so
+                # the element is only complete once what follows is known
+                follow = end
+                while follow < len(buf) and buf[follow] in ' \t\r\n':
+                    follow += 1
+                if eof or (follow < len(buf) and buf[follow] in ',]'):
+                    pos = end
+                    yield element
+                    continue
+        elif eof:
+            raise TruncatedFileError('unexpected end of file')
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + utf8.decode(chunk, eof)
+        pos = 0
+
+
+def is_status(metric):
+    """True for the metric reporting whether a task succeeded."""
+    return metric.get('metric') == MODULE_METRIC_NAME
+
+
+def is_failure(metrics):
+    """True if a task's metrics report that the task failed."""
+    if not isinstance(metrics, list):
+        metrics = [metrics]
+    return any(is_status(m) and m.get('value') == FAIL for m in metrics)
+
+
+class TaskResultCache(object):
+    """Most recent good metrics of each task, refreshed in the background.
+
+       A refresh that fails keeps the previous good metrics and records the
+       failure metrics alongside them.  The success metric of a good
+       refresh is kept apart from its data, so that it is replaced by the
+       failure metrics rather than reported with them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._results = {}
+        self._failures = {}
+        self._refreshing = {}
+
+    def _run(self, task_name, task_runner, task_type, done):
+        try:
+            metrics = task_runner(task_name)
+        except Exception as e:  # noqa
+            metrics = create_task_failed_metric(task_type, task_name, e)
+        if not isinstance(metrics, list):
+            metrics = [metrics]
+        with self._lock:
+            if is_failure(metrics):
+                self._failures[task_name] = metrics
+            else:
+                self._results[task_name] = (
+                    time.time(),
+                    [m for m in metrics if not is_status(m)],
+                    [m for m in metrics if is_status(m)])
+                self._failures.pop(task_name, None)
+            del self._refreshing[task_name]
+        done.set()
+
+    def refresh(self, task_name, task_runner, task_type):
+        """Start a background refresh of a task if one is not running.
+
+           Returns an Event that is set when the refresh completes.
+        """
+        with self._lock:
+            if task_name in self._refreshing:
+                return self._refreshing[task_name]
+            done = self._refreshing[task_name] = threading.Event()
+        thread = threading.Thread(target=self._run,
+                                  args=(task_name, task_runner, task_type,
+                                        done))
+        thread.daemon = True
+        thread.start()
+        return done
+
+    def get(self, task_name):
+        """Return (age, metrics, status) for a task.
+
+           age and metrics are None if the task has never succeeded.
+           status is the list of failure metrics of the latest refresh if
+           it failed, otherwise the success metric of the good refresh.
+        """
+        with self._lock:
+            timestamp, metrics, status = self._results.get(
+                task_name, (None, None, []))
+            status = self._failures.get(task_name, status)
+        if timestamp is None:
+            return None, None, status
+        return time.time() - timestamp, metrics, status
+
+    def is_known(self, task_name):
+        with self._lock:
+            return task_name in self._results or task_name in self._failures
+
+
 class CinderLMScan(checks.AgentCheck):
     # set of check tasks implemented, valid tasks are
     #        'cinder-services'
     #        'cinder-capacity'
     # Tasks added here will be executed by the monasca check process
-    # sequentially in separate processes. We moved the capacity and services
+    # concurrently in separate processes. We moved the capacity and services
     # tasks to a cron job to improve the perfomance of monasca check in
     # response to CINDER-405
     TASKS = (
@@ -131,6 +422,40 @@ class CinderLMScan(checks.AgentCheck):
     COMMAND_TIMEOUT = 15.0
     SUBCOMMAND_PREFIX = '--'
 
+    # command used to start long lived workers when the instance is
+    # configured with 'collector: worker'; tasks fall back to COMMAND_ARGS
+    # if a worker cannot be used
+    WORKER_ARGS = ['/usr/bin/cinder_diag', '--worker']
+    DEFAULT_COLLECTOR = 'subprocess'
+    DEFAULT_WORKERS = 1
+
+    # tasks are run concurrently on up to DEFAULT_TASK_THREADS threads, any
+    # task that has not completed DEFAULT_DEADLINE seconds after the start
+    # of the check is reported as timed out
+    DEFAULT_TASK_THREADS = 4
+    DEFAULT_DEADLINE = 30.0
+
+    # with 'cache_results: true' the check reports the most recent good
+    # metrics of each task straight away and refreshes them in the
+    # background once they are DEFAULT_CACHE_REFRESH seconds old.  Metrics
+    # older than DEFAULT_CACHE_MAX_AGE seconds are no longer reported.
+    DEFAULT_CACHE_RESULTS = False
+    DEFAULT_CACHE_REFRESH = 0.0
+    DEFAULT_CACHE_MAX_AGE = 600.0
+
+    # metrics files are only re-read when their inode, size or mtime
+    # change.  Files modified in the last FILE_SETTLE_TIME seconds may still
+    # be being written and are left until the next check, files larger
+    # than LARGE_FILE_SIZE bytes are parsed incrementally.
+    FILE_SETTLE_TIME = 2.0
+    LARGE_FILE_SIZE = 1024 * 1024
+
+    # metrics files written by cron jobs, either a plain json list of
+    # metrics or as written by 'cinder_diag --output-file' which adds a
+    # generation number and collection timestamp around the list
+    METRICS_FILES = ('/var/cache/cinderlm/*.json',
+                     '/var/cache/cinderlm/*.msgpack')
+
     # list of sub-comands each of which is appended to a shell command
     # with the prefix added
     DEFAULT_SUBCOMMANDS = TASKS
@@ -140,6 +465,9 @@ class CinderLMScan(checks.AgentCheck):
         super(CinderLMScan, self).__init__(
             name, init_config, agent_config, instances)
         self.log = logger or self.log
+        self.worker_pool = None
+        self.result_cache = TaskResultCache()
+        self.file_index = {}
 
     def log_summary(self, task_type, summary):
         task_count = len(summary.get('tasks', []))
@@ -150,6 +478,9 @@ class CinderLMScan(checks.AgentCheck):
         # suppress log noise if no tasks were configured
         logger = self.log.info if task_count else self.log.debug
         logger(msg)
+        for task_name, elapsed in summary.get('durations', []):
+            self.log.debug('%s task %s took %.2fs'
+                           % (task_type.title(), task_name, elapsed))
 
     def _run_command_line_task(self, task_name):
         # we have to call out to a command line
@@ -193,42 +524,225 @@ class CinderLMScan(checks.AgentCheck):
                                                         e)
         return metrics
 
-    def _get_metrics(self, task_names, task_runner):
+    def _run_worker_task(self, task_name):
+        # run the task in a worker that has already imported the collectors
+        try:
+            reply = self.worker_pool.run_task(task_name, self.COMMAND_TIMEOUT)
+        except WorkerError as e:
+            self.log.warn('Worker failed to run task:"%s" with error:"%s", '
+                          'running command instead' % (task_name, e))
+            return self._run_command_line_task(task_name)
+        if reply is None:
+            self.log.warn('Worker task:"%s" timed out after %ss'
+                          % (task_name, self.COMMAND_TIMEOUT))
+            return create_timed_out_metric('worker', task_name)
+        if 'error' in reply:
+            self.log.warn('Worker task:"%s" failed with error:"%s"'
+                          % (task_name, reply['error']))
+            return create_task_failed_metric('worker', task_name,
+                                             reply['error'])
+        metrics = reply.get('metrics', [])
+        metrics.append(create_success_metric('worker', task_name))
+        return metrics
+
+    def _get_metrics(self, task_names, task_runner, task_type='command'):
         reported = []
         summary = defaultdict(list)
+        pending = queue.Queue()
+        finished = queue.Queue()
+        expired = threading.Event()
         for task_name in task_names:
             summary['tasks'].append(task_name)
-            metrics = task_runner(task_name)
+            pending.put(task_name)
+
+        def run_tasks():
+            while not expired.is_set():
+                try:
+                    task_name = pending.get_nowait()
+                except queue.Empty:
+                    return
+                start = time.time()
+                try:
+                    metrics = task_runner(task_name)
+                except Exception as e:  # noqa
+                    metrics = create_task_failed_metric(task_type,
+                                                        task_name, e)
+                finished.put((task_name, metrics, time.time() - start))
+
+        deadline = time.time() + self.deadline
+        for i in range(min(self.task_threads, len(task_names))):
+            # daemon threads, so that a task still running at the deadline
+            # does not hold up the check or the agent's exit
+            thread = threading.Thread(target=run_tasks)
+            thread.daemon = True
+            thread.start()
+
+        outstanding = list(task_names)
+        while outstanding:
+            try:
+                task_name, metrics, elapsed = finished.get(
+                    timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            outstanding.remove(task_name)
+            summary['durations'].append((task_name, elapsed))
             if not isinstance(metrics, list):
                 metrics = [metrics]
             for metric in metrics:
                 reported.append(metric)
+        expired.set()
+
+        for task_name in outstanding:
+            self.log.warn('%s task:"%s" did not complete within %ss'
+                          % (task_type.title(), task_name, self.deadline))
+            reported.append(create_timed_out_metric(task_type, task_name))
+        return reported, summary
+
+    def _get_cached_metrics(self, task_names, task_runner, task_type):
+        reported = []
+        summary = defaultdict(list)
+        deadline = time.time() + self.deadline
+        cold = []
+        for task_name in task_names:
+            summary['tasks'].append(task_name)
+            age, _, _ = self.result_cache.get(task_name)
+            if age is None or age >= self.cache_refresh:
+                done = self.result_cache.refresh(task_name, task_runner,
+                                                 task_type)
+                if not self.result_cache.is_known(task_name):
+                    cold.append(done)
+        # only wait for tasks that have never reported anything, typically
+        # on the first check after the agent starts
+        for done in cold:
+            done.wait(max(deadline - time.time(), 0))
+
+        for task_name in task_names:
+            age, metrics, status = self.result_cache.get(task_name)
+            if metrics is None and not status:
+                self.log.warn('%s task:"%s" has not completed yet'
+                              % (task_type.title(), task_name))
+                reported.append(create_timed_out_metric(task_type, task_name))
+                continue
+            # the failure metrics are current, only report the success
+            # metric, like the data, while the results are fresh enough
+            failed = is_failure(status)
+            if failed:
+                reported.extend(status)
+            if metrics is None:
+                continue
+            if age > self.cache_max_age:
+                self.log.warn('%s task:"%s" results are %.0fs old, no '
+                              'longer reporting them'
+                              % (task_type.title(), task_name, age))
+                if not failed:
+                    reported.append(create_task_failed_metric(
+                        task_type, task_name,
+                        'no results for %.0fs' % age))
+                continue
+            summary['ages'].append((task_name, age))
+            if not failed:
+                metrics = metrics + status
+            for metric in metrics:
+                # copy, the cached metrics are reported again next time
+                metric = dict(metric)
+                value_meta = dict(metric.get('value_meta') or {})
+                value_meta['age'] = '%.0f' % age
+                metric['value_meta'] = value_meta
+                reported.append(metric)
         return reported, summary
 
     def _load_json_file(self, json_file):
+        """Load a metrics file, returning (metrics, collection time).
+
+           The collection time is None for plain lists of metrics.
+        """
         with open(json_file, 'rb') as f:
-            all_json = json.load(f)
-        return all_json
+            head = f.read(64).lstrip()
+            f.seek(0)
+            if head[:1] not in (b'[', b'{'):
+                if msgpack is None:
+                    raise ValueError('not json and msgpack is not installed')
+                doc = msgpack.unpackb(f.read(), raw=False)
+                return doc['metrics'], doc.get('timestamp')
+            # a file being rewritten in place, or cut short by a full disk,
+            # will not end with the end of the json document
+            f.seek(0, os.SEEK_END)
+            f.seek(max(f.tell() - 16, 0))
+            if not f.read().rstrip().endswith((b']', b'}')):
+                raise TruncatedFileError('file is incomplete')
+            f.seek(0)
+            if head.startswith(b'{'):
+                doc = json.load(f)
+                return doc['metrics'], doc.get('timestamp')
+            if os.fstat(f.fileno()).st_size > self.LARGE_FILE_SIZE:
+                all_json = list(iter_json_list(f))
+            else:
+                all_json = json.load(f)
+        return all_json, None
 
-    def _get_file_metrics(self, argsfile):
+    def _get_file_metrics(self, argsfiles):
         reported = []
         errors = []
         jfile = None
-        for jfile in glob.glob(argsfile):
-            if os.path.isfile(jfile):
-                try:
-                    reported.extend(self._load_json_file(jfile))
-                except Exception as e:
-                    errors.extend(['Error: error loading JSON file %s: %s' %
-                                   (jfile, e)])
-                    continue
-            else:
+        now = time.time()
+        index = {}
+        if not isinstance(argsfiles, (list, tuple)):
+            argsfiles = [argsfiles]
+        jfiles = []
+        for argsfile in argsfiles:
+            jfiles.extend(glob.glob(argsfile))
+        for jfile in jfiles:
+            if not os.path.isfile(jfile):
                 errors.extend(['Error: specified input(%s) is not a file' %
                                jfile])
                 continue
+            try:
+                st = os.stat(jfile)
+            except OSError as e:
+                errors.extend(['Error: error reading file %s: %s' %
+                               (jfile, e)])
+                continue
+            key = (st.st_ino, st.st_size, st.st_mtime)
+            entry = self.file_index.get(jfile)
+            if entry is None or entry['key'] != key:
+                if now - st.st_mtime < self.FILE_SETTLE_TIME:
+                    # still being written, use what we had if anything
+                    self.log.debug('Skipping %s, recently modified' % jfile)
+                    key = None
+                else:
+                    start = time.time()
+                    try:
+                        metrics, collected = self._load_json_file(jfile)
+                    except Exception as e:
+                        errors.extend(['Error: error loading JSON file %s: %s'
+                                       % (jfile, e)])
+                        key = None
+                    else:
+                        entry = {'key': key, 'metrics': metrics,
+                                 'collected': collected or st.st_mtime,
+                                 'parse_time': time.time() - start}
+            if entry is None:
+                continue
+            if key is not None:
+                index[jfile] = entry
+            elif jfile in self.file_index:
+                # keep the old entry so the file is re-read next time
+                index[jfile] = self.file_index[jfile]
+
+            # copy, the cached metrics are reported again next time
+            reported.extend(dict(m) for m in entry['metrics'])
+            name = os.path.basename(jfile)
+            reported.append(create_file_metric(
+                'parse_time', name, entry['parse_time'],
+                'Seconds taken to parse %s' % name))
+            reported.append(create_file_metric(
+                'age', name, now - entry['collected'],
+                'Seconds since the metrics in %s were collected' % name))
+        # forget files that have been removed
+        self.file_index = index
         if jfile is None:
             errors.extend(['Warning: no specified input file(%s) exists' %
-                           argsfile])
+                           ','.join(argsfiles)])
         # emit errors but continue to print json
         for msg in errors:
             self.log.error(msg)
@@ -251,17 +765,47 @@ class CinderLMScan(checks.AgentCheck):
             self.subcommands = self._csv_to_list(instance.get('subcommands'))
         self.log.debug('Using subcommands %s' % str(self.subcommands))
 
+        self.task_threads = int(instance.get('task_threads',
+                                             self.DEFAULT_TASK_THREADS))
+        self.deadline = float(instance.get('deadline',
+                                           self.DEFAULT_DEADLINE))
+
+        self.cache_results = str(instance.get(
+            'cache_results', self.DEFAULT_CACHE_RESULTS)).lower() == 'true'
+        self.cache_refresh = float(instance.get('cache_refresh',
+                                                self.DEFAULT_CACHE_REFRESH))
+        self.cache_max_age = float(instance.get('cache_max_age',
+                                                self.DEFAULT_CACHE_MAX_AGE))
+
+        self.collector = instance.get('collector', self.DEFAULT_COLLECTOR)
+        if self.collector == 'worker':
+            workers = int(instance.get('workers', self.DEFAULT_WORKERS))
+            if self.worker_pool is None or self.worker_pool.size != workers:
+                if self.worker_pool is not None:
+                    self.worker_pool.stop()
+                self.worker_pool = WorkerPool(self.WORKER_ARGS, workers)
+        elif self.worker_pool is not None:
+            self.worker_pool.stop()
+            self.worker_pool = None
+
     def check(self, instance):
         self._load_instance_config(instance)
 
         # run command line tasks
-        all_metrics, summary = self._get_metrics(
-            self.subcommands, self._run_command_line_task)
-        self.log_summary('command', summary)
+        if self.collector == 'worker':
+            task_type, task_runner = 'worker', self._run_worker_task
+        else:
+            task_type, task_runner = 'command', self._run_command_line_task
+        if self.cache_results:
+            all_metrics, summary = self._get_cached_metrics(
+                self.subcommands, task_runner, task_type)
+        else:
+            all_metrics, summary = self._get_metrics(
+                self.subcommands, task_runner, task_type)
+        self.log_summary(task_type, summary)
 
         # gather metrics logged to directory
-        all_metrics.extend(
-            self._get_file_metrics('/var/cache/cinderlm/*.json'))
+        all_metrics.extend(self._get_file_metrics(self.METRICS_FILES))
 
         for metric in all_metrics:
             # apply any instance dimensions that may be configured,
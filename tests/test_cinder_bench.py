@@ -0,0 +1,42 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'cinderlm'))
+
+import cinder_bench  # noqa
+
+
+class TestPercentile(unittest.TestCase):
+    def test_hundred_values(self):
+        values = list(range(1, 101))
+        self.assertEqual(cinder_bench.percentile(values, 50), 50)
+        self.assertEqual(cinder_bench.percentile(values, 95), 95)
+        self.assertEqual(cinder_bench.percentile(values, 99), 99)
+        self.assertEqual(cinder_bench.percentile(values, 100), 100)
+
+    def test_few_values(self):
+        values = [0.1, 0.2, 0.3]
+        self.assertEqual(cinder_bench.percentile(values, 0), 0.1)
+        self.assertEqual(cinder_bench.percentile(values, 50), 0.2)
+        self.assertEqual(cinder_bench.percentile(values, 95), 0.3)
+
+    def test_no_values(self):
+        self.assertIsNone(cinder_bench.percentile([], 50))
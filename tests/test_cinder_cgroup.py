@@ -0,0 +1,111 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'cinderlm'))
+
+import cinder_cgroup  # noqa
+
+UNIT = 'openstack-cinder-volume.service'
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+class CgroupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cgroup_dir = tempfile.mkdtemp()
+        self.saved_cgroup_dir = cinder_cgroup.CGROUP_DIR
+        cinder_cgroup.CGROUP_DIR = self.cgroup_dir
+
+    def tearDown(self):
+        cinder_cgroup.CGROUP_DIR = self.saved_cgroup_dir
+        shutil.rmtree(self.cgroup_dir)
+
+    def path(self, *parts):
+        return os.path.join(self.cgroup_dir, *parts)
+
+
+class TestUnified(CgroupTestCase):
+    def setUp(self):
+        super(TestUnified, self).setUp()
+        write(self.path('cgroup.controllers'), 'cpu memory pids\n')
+
+    def test_usage(self):
+        unit_dir = self.path('system.slice', UNIT)
+        write(os.path.join(unit_dir, 'cgroup.procs'), '10\n11\n')
+        write(os.path.join(unit_dir, 'memory.current'), '4096\n')
+        write(os.path.join(unit_dir, 'cpu.stat'),
+              'usage_usec 1500\nuser_usec 1000\nsystem_usec 500\n')
+        self.assertTrue(cinder_cgroup.is_unified())
+        self.assertEqual(cinder_cgroup.unit_usage(UNIT),
+                         {'pids': ['10', '11'], 'memory': 4096,
+                          'cpu_usec': 1500})
+
+    def test_unit_in_slice(self):
+        write(self.path('cinder.slice', UNIT, 'cgroup.procs'), '10\n')
+        usage = cinder_cgroup.unit_usage('cinder.slice/' + UNIT)
+        self.assertEqual(usage['pids'], ['10'])
+
+    def test_no_controllers(self):
+        write(self.path('system.slice', UNIT, 'cgroup.procs'), '10\n')
+        self.assertEqual(cinder_cgroup.unit_usage(UNIT),
+                         {'pids': ['10'], 'memory': None, 'cpu_usec': None})
+
+    def test_missing_unit(self):
+        self.assertIsNone(cinder_cgroup.unit_usage(UNIT))
+
+
+class TestLegacy(CgroupTestCase):
+    def write_controllers(self):
+        write(self.path('memory', 'system.slice', UNIT,
+                        'memory.usage_in_bytes'), '8192\n')
+        write(self.path('cpuacct', 'system.slice', UNIT, 'cpuacct.usage'),
+              '2500000\n')
+
+    def test_usage(self):
+        write(self.path('systemd', 'system.slice', UNIT, 'cgroup.procs'),
+              '10\n')
+        self.write_controllers()
+        self.assertFalse(cinder_cgroup.is_unified())
+        self.assertEqual(cinder_cgroup.unit_usage(UNIT),
+                         {'pids': ['10'], 'memory': 8192, 'cpu_usec': 2500})
+
+    def test_hybrid(self):
+        # the processes are read from the unified hierarchy
+        write(self.path('unified', 'system.slice', UNIT, 'cgroup.procs'),
+              '10\n11\n')
+        write(self.path('systemd', 'system.slice', UNIT, 'cgroup.procs'),
+              '10\n')
+        self.write_controllers()
+        self.assertEqual(cinder_cgroup.unit_usage(UNIT),
+                         {'pids': ['10', '11'], 'memory': 8192,
+                          'cpu_usec': 2500})
+
+    def test_missing_unit(self):
+        os.makedirs(self.path('systemd', 'system.slice'))
+        self.write_controllers()
+        self.assertIsNone(cinder_cgroup.unit_usage(UNIT))
@@ -0,0 +1,260 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+CINDERLM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'cinderlm')
+sys.path.insert(0, CINDERLM_DIR)
+
+import cinder_cache  # noqa
+import cinder_cgroup  # noqa
+import cinder_diag  # noqa
+
+# The monasca plugin forks 'cinder_diag --cinder-services' every cycle
+STARTUP_TIME_LIMIT = 2.0
+
+# Modules that only the other collectors and output formats need
+HEAVY_MODULES = ('cinder_capacity_check', 'cinderclient', 'msgpack',
+                 'swiftlm', 'yaml')
+
+# Run the services-only path and report the modules it loaded on stderr,
+# with the cache directory moved so that no process state is left behind
+SERVICES_ONLY = '''
+import json
+import sys
+sys.path.insert(0, %(cinderlm_dir)r)
+sys.argv = ['cinder_diag', '--json', '--cinder-services']
+import cinder_cache
+cinder_cache.CACHE_DIR = %(cache_dir)r
+import cinder_diag
+try:
+    cinder_diag.main()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(sys.modules)))
+'''
+
+
+class TestServicesStartup(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_services_only_path(self):
+        script = SERVICES_ONLY % {'cinderlm_dir': CINDERLM_DIR,
+                                  'cache_dir': self.cache_dir}
+        start = time.time()
+        process = subprocess.Popen([sys.executable, '-c', script],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        elapsed = time.time() - start
+        self.assertEqual(process.returncode, 0, stderr)
+
+        results = json.loads(stdout.decode('utf-8'))
+        self.assertTrue(results)
+        modules = json.loads(stderr.decode('utf-8'))
+        for name in HEAVY_MODULES:
+            loaded = [module for module in modules
+                      if module == name or module.startswith(name + '.')]
+            self.assertEqual(loaded, [], '%s loaded' % name)
+        self.assertLess(elapsed, STARTUP_TIME_LIMIT)
+
+
+def make_process(proc_dir, pid, argv, fds=2):
+    """Add a process to a fake /proc, without an fd directory if fds is
+       None.
+    """
+    pid_dir = os.path.join(proc_dir, pid)
+    os.mkdir(pid_dir)
+    with open(os.path.join(pid_dir, 'cmdline'), 'wb') as f:
+        f.write(('\0'.join(argv) + '\0').encode('utf-8'))
+    with open(os.path.join(pid_dir, 'stat'), 'w') as f:
+        # utime 100, stime 50, 3 threads, starttime 12345
+        f.write('%s (%s) S 1 1 1 0 -1 0 0 0 0 0 100 50 0 0 20 0 3 0 '
+                '12345 1000 200 0\n' % (pid, os.path.basename(argv[0])))
+    with open(os.path.join(pid_dir, 'statm'), 'w') as f:
+        f.write('1000 200 0 0 0 0 0\n')
+    with open(os.path.join(pid_dir, 'status'), 'w') as f:
+        f.write('Name:\t%s\nVmSwap:\t       8 kB\n'
+                % os.path.basename(argv[0]))
+    if fds is not None:
+        os.mkdir(os.path.join(pid_dir, 'fd'))
+        for fd in range(fds):
+            open(os.path.join(pid_dir, 'fd', str(fd)), 'w').close()
+
+
+class ProcTestCase(unittest.TestCase):
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp()
+        self.saved_proc_dir = cinder_diag.PROC_DIR
+        cinder_diag.PROC_DIR = self.proc_dir
+
+    def tearDown(self):
+        cinder_diag.PROC_DIR = self.saved_proc_dir
+        shutil.rmtree(self.proc_dir)
+
+
+class TestResourceMetrics(ProcTestCase):
+    def resource_metrics(self, pids):
+        state = {'processes': {}}
+        results = cinder_diag._resource_metrics(
+            pids, {'component': 'cinder-volume'}, {}, state, time.time())
+        prefix = cinder_diag.MODULE_METRIC_NAME + '.'
+        return dict((m['metric'][len(prefix):], m['value'])
+                    for m in results)
+
+    def test_totals(self):
+        make_process(self.proc_dir, '10', ['/usr/bin/cinder-volume'])
+        make_process(self.proc_dir, '11', ['/usr/bin/cinder-volume'], 3)
+        values = self.resource_metrics(['10', '11'])
+        self.assertEqual(values['fds.total'], 5)
+        self.assertEqual(values['fds.max'], 3)
+        self.assertEqual(values['threads.total'], 6)
+        self.assertEqual(values['swap.max'], 8192)
+        # no cpu rate without a previous run
+        self.assertNotIn('cpu.total', values)
+
+    def test_unreadable_counter_left_out(self):
+        make_process(self.proc_dir, '10', ['/usr/bin/cinder-volume'], None)
+        values = self.resource_metrics(['10'])
+        self.assertNotIn('fds.total', values)
+        self.assertNotIn('fds.max', values)
+        self.assertEqual(values['threads.total'], 3)
+
+    def test_not_running(self):
+        values = self.resource_metrics([])
+        self.assertEqual(values['rss.total'], 0)
+        self.assertEqual(values['fds.total'], 0)
+
+
+class TestMatchProcesses(ProcTestCase):
+    SERVICES = ('cinder-api', 'cinder-backup', 'cinder-scheduler',
+                'cinder-volume')
+
+    def matches(self):
+        index = cinder_diag.build_process_index()
+        return cinder_diag.match_processes(self.SERVICES, index)
+
+    def test_installed_script(self):
+        make_process(self.proc_dir, '10',
+                     ['/opt/stack/venv/bin/cinder-scheduler',
+                      '--config-file', '/etc/cinder/cinder.conf'])
+        self.assertEqual(self.matches()['cinder-scheduler'], ['10'])
+
+    def test_python_launched_script(self):
+        make_process(self.proc_dir, '10',
+                     ['/usr/bin/python2.7', '-u',
+                      '/opt/stack/venv/bin/cinder-volume',
+                      '--config-file', '/etc/cinder/cinder.conf'])
+        self.assertEqual(self.matches()['cinder-volume'], ['10'])
+
+    def test_process_titles(self):
+        # setproctitle flattens the title into a single argument
+        make_process(self.proc_dir, '10',
+                     ['cinder-backup: master process [cinder-backup]'])
+        make_process(self.proc_dir, '11', ['(wsgi:cinder-api)', '-k', 'start'])
+        make_process(self.proc_dir, '12', ['(wsgi:cinder-api) -k start'])
+        matches = self.matches()
+        self.assertEqual(matches['cinder-backup'], ['10'])
+        self.assertEqual(sorted(matches['cinder-api']), ['11', '12'])
+
+    def test_not_matched_by_argument(self):
+        make_process(self.proc_dir, '10', ['grep', 'cinder-volume'])
+        make_process(self.proc_dir, '11',
+                     ['/usr/bin/tail', '-f', '/var/log/cinder/cinder-api'])
+        matches = self.matches()
+        self.assertEqual(matches['cinder-volume'], [])
+        self.assertEqual(matches['cinder-api'], [])
+
+    def test_vanished_and_kernel_processes(self):
+        make_process(self.proc_dir, '10', ['/usr/bin/cinder-volume'])
+        # a pid that exited between listing /proc and reading it
+        os.mkdir(os.path.join(self.proc_dir, '11'))
+        # kernel threads have an empty cmdline
+        os.mkdir(os.path.join(self.proc_dir, '12'))
+        open(os.path.join(self.proc_dir, '12', 'cmdline'), 'w').close()
+        os.mkdir(os.path.join(self.proc_dir, 'self'))
+        self.assertEqual(cinder_diag.build_process_index(),
+                         {'10': ['/usr/bin/cinder-volume']})
+        self.assertEqual(self.matches()['cinder-volume'], ['10'])
+        self.assertEqual(cinder_diag.check_process('cinder-volume'), 1)
+
+    def test_missing_proc_dir(self):
+        cinder_diag.PROC_DIR = os.path.join(self.proc_dir, 'missing')
+        self.assertEqual(cinder_diag.build_process_index(), {})
+
+
+class TestCheckCinderProcesses(ProcTestCase):
+    def setUp(self):
+        super(TestCheckCinderProcesses, self).setUp()
+        self.cgroup_dir = tempfile.mkdtemp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.saved = (cinder_cgroup.CGROUP_DIR, cinder_cache.CACHE_DIR,
+                      cinder_diag.CINDERLM_CONF_FILE)
+        cinder_cgroup.CGROUP_DIR = self.cgroup_dir
+        cinder_cache.CACHE_DIR = self.cache_dir
+        # the default unit names
+        cinder_diag.CINDERLM_CONF_FILE = os.path.join(self.cache_dir,
+                                                      'missing.conf')
+        with open(os.path.join(self.cgroup_dir, 'cgroup.controllers'),
+                  'w') as f:
+            f.write('memory\n')
+
+    def tearDown(self):
+        (cinder_cgroup.CGROUP_DIR, cinder_cache.CACHE_DIR,
+         cinder_diag.CINDERLM_CONF_FILE) = self.saved
+        shutil.rmtree(self.cgroup_dir)
+        shutil.rmtree(self.cache_dir)
+        super(TestCheckCinderProcesses, self).tearDown()
+
+    def add_unit(self, unit, pids):
+        unit_dir = os.path.join(self.cgroup_dir, 'system.slice', unit)
+        os.makedirs(unit_dir)
+        with open(os.path.join(unit_dir, 'cgroup.procs'), 'w') as f:
+            f.write(''.join('%s\n' % pid for pid in pids))
+        with open(os.path.join(unit_dir, 'memory.current'), 'w') as f:
+            f.write('4096\n')
+
+    def counts(self):
+        return dict((m['dimensions']['component'], m['value'])
+                    for m in cinder_diag.check_cinder_processes()
+                    if m['metric'] == cinder_diag.MODULE_METRIC_NAME)
+
+    def test_unit_and_fallback(self):
+        make_process(self.proc_dir, '10', ['/usr/bin/cinder-volume'])
+        make_process(self.proc_dir, '11',
+                     ['/usr/bin/python', '/usr/bin/cinder-rootwrap'])
+        make_process(self.proc_dir, '20', ['/usr/bin/cinder-volume'])
+        make_process(self.proc_dir, '30', ['/usr/bin/cinder-scheduler'])
+        # only the unit's service process counts, not its helpers or a
+        # process of the same name outside the unit
+        self.add_unit('openstack-cinder-volume.service', ['10', '11'])
+        counts = self.counts()
+        self.assertEqual(counts['cinder-volume'], 1)
+        # no cgroup for the other units, found by the scan of PROC_DIR
+        self.assertEqual(counts['cinder-scheduler'], 1)
+        self.assertEqual(counts['cinder-api'], 0)
@@ -0,0 +1,83 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+from datetime import datetime
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'cinderlm'))
+
+import cinder_sweep  # noqa
+
+NOW = datetime(2018, 1, 1, 12, 0, 0)
+
+
+class FakeResource(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeManager(object):
+    def __init__(self, resources):
+        self.resources = resources
+
+    def list(self, search_opts=None, marker=None, limit=None):
+        return [r for r in self.resources
+                if r.name == search_opts['name'].strip('^$')]
+
+
+class FakeWatcher(object):
+    def __init__(self, resources):
+        self._manager = FakeManager(resources)
+
+    def manager(self, kind):
+        return self._manager
+
+    def name_filter(self, kind, name):
+        return {'name': '^%s$' % name}
+
+
+class TestAge(unittest.TestCase):
+    def test_volume_created_at(self):
+        volume = FakeResource(created_at='2018-01-01T10:00:00.000000')
+        self.assertEqual(cinder_sweep.age(volume, NOW), 7200)
+
+    def test_server_created(self):
+        # nova servers have no created_at
+        server = FakeResource(created='2018-01-01T11:00:00Z')
+        self.assertEqual(cinder_sweep.age(server, NOW), 3600)
+
+    def test_unknown(self):
+        self.assertIsNone(cinder_sweep.age(FakeResource(), NOW))
+        self.assertIsNone(cinder_sweep.age(FakeResource(created='never'),
+                                           NOW))
+
+
+class TestFind(unittest.TestCase):
+    def test_old_servers_are_found(self):
+        old = FakeResource(id='old', name='__chkvm__',
+                           created='2000-01-01T00:00:00Z')
+        new = FakeResource(id='new', name='__chkvm__',
+                           created=datetime.utcnow().strftime(
+                               '%Y-%m-%dT%H:%M:%SZ'))
+        other = FakeResource(id='other', name='vm',
+                             created='2000-01-01T00:00:00Z')
+        sweeper = cinder_sweep.Sweeper(FakeWatcher([old, new, other]),
+                                       min_age=7200)
+        found = sweeper.find('server', ['__chkvm__'])
+        self.assertEqual([resource.id for resource, age in found], ['old'])
@@ -0,0 +1,50 @@
+#
+# (c) Copyright 2018 SUSE LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+#
+
+import io
+import json
+import unittest
+
+try:
+    from cinderlm.monasca.check_plugins import cinderlm_check
+except ImportError:
+    # the plugin needs monasca-agent
+    cinderlm_check = None
+
+
+@unittest.skipIf(cinderlm_check is None, 'monasca-agent is not installed')
+class TestIterJsonList(unittest.TestCase):
+    def parse(self, text, chunk_size):
+        f = io.BytesIO(text.encode('utf-8'))
+        return list(cinderlm_check.iter_json_list(f, chunk_size))
+
+    def test_scalars_split_across_chunks(self):
+        values = [123, 456, -7.5e3, 1.25, 0, 'abc', True, None]
+        text = json.dumps(values)
+        for chunk_size in range(1, len(text) + 1):
+            self.assertEqual(self.parse(text, chunk_size), values)
+
+    def test_whitespace_after_elements(self):
+        self.assertEqual(self.parse('[ 12 ,\n 34\n]\n', 2), [12, 34])
+
+    def test_metrics(self):
+        metrics = [{'metric': 'cinderlm.test', 'value': 1.0,
+                    'dimensions': {'hostname': 'h'}}] * 3
+        self.assertEqual(self.parse(json.dumps(metrics), 7), metrics)
+
+    def test_truncated(self):
+        self.assertRaises(cinderlm_check.TruncatedFileError,
+                          self.parse, '[123, 45', 2)